@@ -0,0 +1,127 @@
+import time
+import asyncio
+import argparse
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+
+from rich.console import Console
+from rich.table import Table
+from telethon import types
+
+from src.database import rows_from_message
+from src.utils import get_username
+
+from .fake_telegram import FakeTelegramClient
+
+# Per-message cost of turning a fetched message into rows ready for the writer: the previous
+# implementation (dataclasses, sender resolved once per row, tuples rebuilt in batch_insert_*) against
+# rows_from_message, whose NamedTuple rows are handed to the writer as they are.
+
+@dataclass
+class LegacyMessageRow:
+    message_id: int
+    sender_id: int
+    chat_id: int
+    text: str
+    date: datetime
+    is_historical: bool
+
+    @classmethod
+    async def from_patched_message(cls, message, is_historical=False):
+        sender = await message.get_sender()
+        if sender:
+            return cls(
+                chat_id=message.chat_id,
+                message_id=message.id,
+                sender_id=sender.id,
+                text=message.text,
+                date=message.date.replace(tzinfo=None),
+                is_historical=is_historical,
+            )
+
+@dataclass
+class LegacyUserRow:
+    user_id: int
+    username: str
+    first_name: str
+    last_name: str
+    is_bot: bool
+    is_premium: bool
+    is_scam: bool
+    is_fake: bool
+    is_verified: bool
+
+    @classmethod
+    async def from_patched_message(cls, message):
+        sender = await message.get_sender()
+        if isinstance(sender, types.User):
+            return cls(
+                user_id=sender.id,
+                username=get_username(sender),
+                first_name=sender.first_name,
+                last_name=sender.last_name,
+                is_bot=sender.bot,
+                is_premium=sender.premium,
+                is_scam=sender.scam,
+                is_fake=sender.fake,
+                is_verified=sender.verified,
+            )
+
+async def convert_before(messages):
+    users = []
+    message_rows = []
+    for message in messages:
+        if user := await LegacyUserRow.from_patched_message(message):
+            users.append(user)
+        if message_row := await LegacyMessageRow.from_patched_message(message, is_historical=True):
+            message_rows.append(message_row)
+    user_records = [(row.user_id, row.username, row.first_name, row.last_name, row.is_bot, row.is_premium, row.is_scam, row.is_fake, row.is_verified) for row in users]
+    message_records = [(row.message_id, row.sender_id, row.chat_id, row.text, row.date, row.is_historical) for row in message_rows]
+    return user_records, message_records
+
+async def convert_after(messages):
+    users = []
+    message_rows = []
+    for message in messages:
+        user, message_row = await rows_from_message(message, is_historical=True)
+        if user:
+            users.append(user)
+        if message_row:
+            message_rows.append(message_row)
+    return users, message_rows
+
+def measure(convert, messages, repeat):
+    cpu_times = []
+    for _ in range(repeat):
+        start = time.process_time()
+        asyncio.run(convert(messages))
+        cpu_times.append(time.process_time() - start)
+    tracemalloc.start()
+    result = asyncio.run(convert(messages))
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return min(cpu_times), current, peak
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of per-message row conversion')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    client = FakeTelegramClient(chats=1, messages_per_chat=args.messages)
+    messages = client.chats[0].get_messages(args.messages, 0, 0, reverse=True)
+
+    table = Table(title=f'Row conversion, {args.messages} messages')
+    table.add_column('Implementation')
+    table.add_column('CPU per message', justify='right')
+    table.add_column('Retained bytes per message', justify='right')
+    table.add_column('Peak bytes per message', justify='right')
+    for name, convert in (('before', convert_before), ('after', convert_after)):
+        cpu_time, retained, peak = measure(convert, messages, args.repeat)
+        table.add_row(name, f'{cpu_time / args.messages * 1e6:.2f} µs', f'{retained / args.messages:.0f}', f'{peak / args.messages:.0f}')
+    Console().print(table)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import re
+import asyncio
+from collections import Counter
+
+class FakePool:
+    # In-memory stand-in for an asyncpg pool. Writes are counted per table and cost a fixed latency
+    # per statement plus a per-row cost; reads return nothing, so the scheduler never finds work and
+    # scenarios queue chats for backfill themselves.
+
+    def __init__(self, statement_latency=0.002, row_latency=0.000005):
+        self.statement_latency = statement_latency
+        self.row_latency = row_latency
+        self.rows_written = Counter()
+        self.statements = 0
+
+    def acquire(self):
+        return FakeAcquire(FakeConnection(self))
+
+    async def close(self):
+        pass
+
+class FakeAcquire:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def __aenter__(self):
+        return self.connection
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+class FakeConnection:
+
+    def __init__(self, pool: FakePool):
+        self.pool = pool
+        self.staged_rows = 0
+
+    async def write(self, query, rows):
+        self.pool.statements += 1
+        if match := re.search(r'INSERT INTO (\w+)', query):
+            self.pool.rows_written[match.group(1)] += rows
+        await asyncio.sleep(self.pool.statement_latency + rows * self.pool.row_latency)
+
+    async def execute(self, query, *args):
+        if 'INSERT INTO' not in query:
+            rows = 0
+        elif 'FROM staging_' in query:
+            rows, self.staged_rows = self.staged_rows, 0
+        else:
+            rows = 1
+        await self.write(query, rows)
+
+    async def executemany(self, query, args):
+        await self.write(query, len(args))
+
+    async def executemany_prepared(self, query, args):
+        await self.write(query, len(args))
+
+    async def execute_prepared(self, query, *args):
+        # Array parameters, one element per row
+        await self.write(query, len(args[0]) if args else 1)
+
+    async def copy_records_to_table(self, table_name, records, columns=None):
+        if table_name.startswith('staging_'):
+            self.staged_rows = len(records)
+            await self.write('', len(records))
+        else:
+            await self.write(f'INSERT INTO {table_name}', len(records))
+
+    async def fetch(self, query, *args):
+        await self.write(query, 0)
+        return []
+
+    async def fetchrow(self, query, *args):
+        await self.write(query, 0)
+        return None
+
+    async def fetchval(self, query, *args):
+        await self.write(query, 0)
+        return None
+
+    def transaction(self):
+        return FakeTransaction()
+
+class FakeTransaction:
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
@@ -0,0 +1,157 @@
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+from telethon import types
+
+class FakeTelegramClient:
+    # Stand-in for TelegramClient serving synthetic dialogs and message histories, with a fixed
+    # latency per request
+
+    def __init__(self, chats=10, messages_per_chat=10000, senders=500, request_latency=0.05, seed=0):
+        self.random = random.Random(seed)
+        self.request_latency = request_latency
+        self.event_handlers = []
+        self.requests = 0
+        self.rate_controller = None
+        self.senders = [
+            types.User(id=1_000_000 + i, first_name=f'User {i}', username=f'user{i}', bot=False, premium=False, scam=False, fake=False, verified=False)
+            for i in range(senders)
+        ]
+        self.chats = [FakeChat(self, -1_000_000_000 - i, f'Chat {i}', messages_per_chat) for i in range(chats)]
+        self.chats_by_id = {chat.id: chat for chat in self.chats}
+
+    def add_event_handler(self, callback, event=None):
+        self.event_handlers.append(callback)
+
+    async def start(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def request(self):
+        # Like RateControlledTelegramClient, every request goes through the rate controller when there is one
+        if self.rate_controller is not None:
+            await self.rate_controller.acquire()
+        self.requests += 1
+        await asyncio.sleep(self.request_latency)
+        if self.rate_controller is not None:
+            self.rate_controller.record_success(self.request_latency)
+
+    async def iter_dialogs(self):
+        for i in range(0, len(self.chats), 100):
+            await self.request()
+            for chat in self.chats[i:i + 100]:
+                yield chat.to_dialog()
+
+    async def get_messages(self, chat_id, limit=None, reverse=False, min_id=0, max_id=0, search=None):
+        await self.request()
+        chat = self.chats_by_id[chat_id]
+        if search is not None:
+            # Like Telegram, a request without a limit returns the newest message along with the total
+            return FakeTotalList([chat.get_message(chat.message_count)] if chat.message_count else [], total=chat.message_count)
+        return FakeTotalList(chat.get_messages(limit or 1, min_id or 0, max_id or 0, reverse), total=chat.message_count)
+
+    async def iter_messages(self, chat_id, limit=None, reverse=False, min_id=0, max_id=0, wait_time=None):
+        while True:
+            messages = await self.get_messages(chat_id, limit=100, reverse=reverse, min_id=min_id, max_id=max_id)
+            for message in messages:
+                yield message
+            if len(messages) < 100:
+                return
+            if reverse:
+                min_id = messages[-1].id
+            else:
+                max_id = messages[-1].id
+
+    async def emit_new_messages(self, rate, duration):
+        # Fires NewMessage events through the registered handlers at `rate` events per second, dispatching
+        # them one after another like Telethon does
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        emitted = 0
+        while (elapsed := loop.time() - start) < duration:
+            due = int(elapsed * rate) - emitted
+            for _ in range(due):
+                chat = self.random.choice(self.chats)
+                event = FakeNewMessageEvent(chat, chat.new_message())
+                for handler in self.event_handlers:
+                    await handler(event)
+            emitted += max(due, 0)
+            await asyncio.sleep(min(1 / rate, 0.01))
+        return emitted
+
+class FakeChat:
+
+    def __init__(self, client: FakeTelegramClient, id, title, message_count):
+        self.client = client
+        self.id = id
+        self.message_count = message_count
+        self.start_date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.entity = types.Channel(id=id, title=title, photo=types.ChatPhotoEmpty(), date=self.start_date, megagroup=True, participants_count=len(client.senders))
+
+    def get_message(self, message_id):
+        sender = self.client.senders[message_id % len(self.client.senders)]
+        date = self.start_date + timedelta(minutes=message_id)
+        return FakeMessage(message_id, self.id, sender, date, f'Message {message_id} in chat {self.id}')
+
+    def get_messages(self, limit, min_id, max_id, reverse):
+        upper = min(max_id - 1, self.message_count) if max_id else self.message_count
+        if reverse:
+            ids = range(min_id + 1, min(min_id + limit, upper) + 1)
+        else:
+            ids = range(upper, max(upper - limit, min_id), -1)
+        return [self.get_message(message_id) for message_id in ids]
+
+    def new_message(self):
+        self.message_count += 1
+        message = self.get_message(self.message_count)
+        message.date = datetime.now(timezone.utc)
+        return message
+
+    def to_dialog(self):
+        return FakeDialog(self, self.get_message(self.message_count))
+
+class FakeMessage:
+
+    def __init__(self, id, chat_id, sender, date, text):
+        self.id = id
+        self.chat_id = chat_id
+        self.sender = sender
+        self.sender_id = sender.id
+        self.date = date
+        self.text = text
+
+    async def get_sender(self):
+        return self.sender
+
+class FakeDialog:
+
+    def __init__(self, chat: FakeChat, message: FakeMessage):
+        self.id = chat.id
+        self.entity = chat.entity
+        self.message = message
+        self.date = message.date
+        self.is_user = False
+        self.is_group = True
+        self.is_channel = True
+
+class FakeNewMessageEvent:
+
+    def __init__(self, chat: FakeChat, message: FakeMessage):
+        self.chat = chat
+        self.message = message
+        self.chat_id = chat.id
+        self.date = message.date
+        self.is_group = True
+        self.is_channel = True
+
+    async def get_chat(self):
+        return self.chat.entity
+
+class FakeTotalList(list):
+
+    def __init__(self, items, total):
+        super().__init__(items)
+        self.total = total
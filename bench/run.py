@@ -0,0 +1,175 @@
+import json
+import time
+import asyncio
+import argparse
+import resource
+import statistics
+
+from rich.console import Console
+from rich.table import Table
+
+from src.database import DatabaseManager
+from src.websocket import WebSocketManager
+from src.telegram import TelegramManager
+
+from .fake_telegram import FakeTelegramClient
+from .fake_database import FakePool
+
+class Benchmark:
+    # Drives the real TelegramManager loops against a FakeTelegramClient and records ingest throughput,
+    # buffered row counts over time and flush latencies
+
+    def __init__(self, args):
+        self.args = args
+        self.client = FakeTelegramClient(
+            chats=args.chats,
+            messages_per_chat=args.messages_per_chat,
+            request_latency=args.telegram_latency / 1000,
+        )
+        self.database = DatabaseManager(args.dsn)
+        self.database.insert_mode = args.insert_mode
+        if args.dsn is None:
+            self.database.pool = FakePool(statement_latency=args.db_latency / 1000)
+            self.database.read_pool = FakePool(statement_latency=args.db_latency / 1000)
+        self.websocket = WebSocketManager(None, None, self.database)
+        self.telegram = TelegramManager(None, None, self.database, self.websocket, client=self.client)
+        self.telegram.historical_messages_workers = args.workers
+        self.telegram.rate_controller.rate = self.telegram.rate_controller.max_rate = args.request_rate
+        self.client.rate_controller = self.telegram.rate_controller
+
+        self.messages_written = 0
+        self.flush_latencies = []
+        self.queue_depth_samples = []
+        self.instrument()
+
+    def instrument(self):
+        batch_insert_from_queue = self.database.batch_insert_from_queue
+        batch_insert_messages = self.database.batch_insert_messages
+
+        async def timed_batch_insert_from_queue():
+            start = time.perf_counter()
+            await batch_insert_from_queue()
+            self.flush_latencies.append(time.perf_counter() - start)
+
+        async def counted_batch_insert_messages(messages, *args, **kwargs):
+            await batch_insert_messages(messages, *args, **kwargs)
+            self.messages_written += len(messages)
+
+        self.database.batch_insert_from_queue = timed_batch_insert_from_queue
+        self.database.batch_insert_messages = counted_batch_insert_messages
+
+    async def sample_queue_depth(self, start):
+        while True:
+            depths = {row_type.__name__: len(buffer) for row_type, buffer in self.database._buffers.items()}
+            self.queue_depth_samples.append((time.perf_counter() - start, depths))
+            await asyncio.sleep(self.args.sample_interval)
+
+    async def backfill_scenario(self):
+        for chat in self.client.chats:
+            self.telegram.historical_messages_scheduled_chat_set.add(chat.id)
+            await self.telegram.historical_messages_chat_queue.put((0, chat.id))
+        historical_messages_task = asyncio.create_task(self.telegram.historical_messages_loop())
+        while self.telegram.historical_messages_scheduled_chat_set:
+            await asyncio.sleep(0.1)
+        historical_messages_task.cancel()
+
+    async def live_scenario(self):
+        live_messages_task = asyncio.create_task(self.telegram.live_messages_loop())
+        await self.client.emit_new_messages(self.args.live_rate, self.args.duration)
+        await asyncio.gather(*(queue.join() for queue in self.telegram.live_messages_queues))
+        live_messages_task.cancel()
+
+    async def dialogs_scenario(self):
+        dialogs_task = asyncio.create_task(self.telegram.dialogs_loop())
+        await asyncio.sleep(self.args.duration)
+        dialogs_task.cancel()
+
+    async def mixed_scenario(self):
+        await asyncio.gather(self.backfill_scenario(), self.live_scenario())
+
+    async def run(self):
+        scenario = getattr(self, f'{self.args.scenario}_scenario')
+        start = time.perf_counter()
+        database_task = asyncio.create_task(self.database.run())
+        sampler_task = asyncio.create_task(self.sample_queue_depth(start))
+        await scenario()
+        self.database.stop()
+        await database_task
+        elapsed = time.perf_counter() - start
+        sampler_task.cancel()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        latencies = sorted(self.flush_latencies)
+        return {
+            'scenario': self.args.scenario,
+            'insert_mode': self.args.insert_mode,
+            'elapsed_s': elapsed,
+            'messages_written': self.messages_written,
+            'messages_per_s': self.messages_written / elapsed if elapsed else 0.0,
+            'telegram_requests': self.client.requests,
+            'flushes': len(latencies),
+            'flush_latency_ms': {
+                'p50': percentile(latencies, 50) * 1000,
+                'p90': percentile(latencies, 90) * 1000,
+                'p99': percentile(latencies, 99) * 1000,
+                'max': (latencies[-1] if latencies else 0.0) * 1000,
+            },
+            'max_queue_depth': {
+                name: max(depths[name] for _, depths in self.queue_depth_samples)
+                for name in (self.queue_depth_samples[0][1] if self.queue_depth_samples else {})
+            },
+            'mean_queue_depth': statistics.fmean(sum(depths.values()) for _, depths in self.queue_depth_samples) if self.queue_depth_samples else 0.0,
+            'queue_depth_samples': self.queue_depth_samples,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+
+def print_report(report):
+    table = Table(title=f"Scenario '{report['scenario']}' ({report['insert_mode']})")
+    table.add_column('Metric')
+    table.add_column('Value', justify='right')
+    table.add_row('Elapsed', f"{report['elapsed_s']:.2f} s")
+    table.add_row('Messages written', str(report['messages_written']))
+    table.add_row('Throughput', f"{report['messages_per_s']:.1f} msgs/s")
+    table.add_row('Telegram requests', str(report['telegram_requests']))
+    table.add_row('Flushes', str(report['flushes']))
+    for name, value in report['flush_latency_ms'].items():
+        table.add_row(f'Flush latency {name}', f'{value:.1f} ms')
+    for name, value in report['max_queue_depth'].items():
+        table.add_row(f'Max buffered {name}', str(value))
+    table.add_row('Mean buffered rows', f"{report['mean_queue_depth']:.1f}")
+    table.add_row('Peak RSS', f"{report['peak_rss_mb']:.1f} MB")
+    Console().print(table)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Offline ingest benchmark for the telegram indexer')
+    parser.add_argument('scenario', choices=['backfill', 'live', 'dialogs', 'mixed'])
+    parser.add_argument('--dsn', help='Run against this PostgreSQL database instead of the in-memory pool')
+    parser.add_argument('--insert-mode', default='executemany', choices=['executemany', 'copy'])
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--messages-per-chat', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--live-rate', type=float, default=200, help='NewMessage events per second')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run the live and dialogs scenarios for')
+    parser.add_argument('--telegram-latency', type=float, default=50, help='Milliseconds per Telegram request')
+    parser.add_argument('--request-rate', type=float, default=1000, help='Telegram requests per second allowed by the rate controller')
+    parser.add_argument('--db-latency', type=float, default=2, help='Milliseconds per statement for the in-memory pool')
+    parser.add_argument('--sample-interval', type=float, default=0.5, help='Seconds between queue depth samples')
+    parser.add_argument('--json', help='Also write the full report, including queue depth samples, to this file')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    report = asyncio.run(Benchmark(args).run())
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+-- Adds the per-chat sync state maintained by the batch writer and seeds it from the existing messages.
+-- Run it with the indexer stopped, since the seeding aggregate scans the whole messages table once.
+
+BEGIN;
+
+CREATE TABLE chats_sync_state (
+    chat_id BIGINT PRIMARY KEY,
+    latest_message_id BIGINT,
+    historical_message_id BIGINT,
+    historical_message_date TIMESTAMP,
+    historical_message_count BIGINT NOT NULL DEFAULT 0,
+    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+);
+
+INSERT INTO chats_sync_state (chat_id, latest_message_id, historical_message_id, historical_message_count)
+SELECT
+    chat_id,
+    MAX(message_id),
+    MAX(message_id) FILTER (WHERE is_historical),
+    COUNT(*) FILTER (WHERE is_historical)
+FROM messages
+GROUP BY chat_id;
+
+UPDATE chats_sync_state s
+SET historical_message_date = m.date
+FROM messages m
+WHERE m.chat_id = s.chat_id AND m.message_id = s.historical_message_id;
+
+COMMIT;
@@ -0,0 +1,8 @@
+-- Adds the full-text search vector to messages. Adding a stored generated column rewrites the table,
+-- so expect this to take a while (and the disk space of a second copy) on large databases.
+
+ALTER TABLE messages
+    ADD COLUMN text_search TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED;
+
+CREATE INDEX CONCURRENTLY messages_text_search_idx ON messages USING GIN (text_search);
+CREATE INDEX CONCURRENTLY messages_date_idx ON messages (date);
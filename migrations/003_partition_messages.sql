@@ -0,0 +1,71 @@
+-- Converts messages into a table range-partitioned by month on date, copying the existing rows into
+-- monthly partitions. Run it with the indexer stopped. The old table is kept as
+-- messages_unpartitioned; drop it once the new one has been checked.
+
+BEGIN;
+
+DROP VIEW messages_with_details;
+
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_chat_id_fkey TO messages_unpartitioned_chat_id_fkey;
+ALTER INDEX messages_text_search_idx RENAME TO messages_unpartitioned_text_search_idx;
+ALTER INDEX messages_date_idx RENAME TO messages_unpartitioned_date_idx;
+
+CREATE TABLE messages (
+    message_id BIGINT,
+    sender_id BIGINT,
+    chat_id BIGINT,
+    text TEXT,
+    date TIMESTAMP NOT NULL,
+    is_historical BOOLEAN,
+    insertion_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    text_search TSVECTOR GENERATED ALWAYS AS (to_tsvector('simple', coalesce(text, ''))) STORED,
+    PRIMARY KEY (chat_id, message_id, date),
+    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+) PARTITION BY RANGE (date);
+
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+DO $$
+DECLARE
+    month TIMESTAMP;
+BEGIN
+    FOR month IN
+        SELECT generate_series(date_trunc('month', MIN(date)), date_trunc('month', MAX(date)), INTERVAL '1 month')
+        FROM messages_unpartitioned
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            'messages_p' || to_char(month, 'YYYY_MM'), month, month + INTERVAL '1 month'
+        );
+    END LOOP;
+END
+$$;
+
+INSERT INTO messages (message_id, sender_id, chat_id, text, date, is_historical, insertion_time)
+SELECT message_id, sender_id, chat_id, text, date, is_historical, insertion_time
+FROM messages_unpartitioned
+WHERE date IS NOT NULL;
+
+-- Built after the copy, which is much faster than maintaining them row by row
+CREATE INDEX messages_text_search_idx ON messages USING GIN (text_search);
+CREATE INDEX messages_date_idx ON messages (date);
+
+CREATE VIEW messages_with_details AS
+SELECT
+    m.message_id,
+    m.text,
+    u.username,
+    c.title AS chat_title,
+    m.date
+FROM
+    messages m
+JOIN
+    users u ON m.sender_id = u.user_id
+JOIN
+    chats c ON m.chat_id = c.chat_id
+ORDER BY
+    m.date DESC;
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- Adds the table tracking the id ranges of chats backfilled in parallel segments.
+
+BEGIN;
+
+CREATE TABLE historical_segments (
+    chat_id BIGINT,
+    start_id BIGINT,
+    end_id BIGINT NOT NULL,
+    progress_id BIGINT NOT NULL,
+    PRIMARY KEY (chat_id, start_id),
+    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+);
+
+COMMIT;
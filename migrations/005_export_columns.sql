@@ -0,0 +1,27 @@
+-- Exposes the keys and insertion time on messages_with_details for src.export, and indexes insertion_time
+-- so incremental exports don't scan the whole table.
+
+BEGIN;
+
+CREATE OR REPLACE VIEW messages_with_details AS
+SELECT
+    m.message_id,
+    m.text,
+    u.username,
+    c.title AS chat_title,
+    m.date,
+    m.chat_id,
+    m.sender_id,
+    m.insertion_time
+FROM
+    messages m
+JOIN
+    users u ON m.sender_id = u.user_id
+JOIN
+    chats c ON m.chat_id = c.chat_id
+ORDER BY
+    m.date DESC;
+
+CREATE INDEX messages_insertion_time_idx ON messages (insertion_time);
+
+COMMIT;
@@ -0,0 +1,18 @@
+-- Adds the session heartbeats and chat leases used to shard ingestion between several Telegram accounts.
+
+BEGIN;
+
+CREATE TABLE ingest_sessions (
+    session TEXT PRIMARY KEY,
+    heartbeat_time TIMESTAMP NOT NULL
+);
+
+CREATE TABLE chat_leases (
+    chat_id BIGINT PRIMARY KEY,
+    session TEXT NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX chat_leases_session_idx ON chat_leases (session);
+
+COMMIT;
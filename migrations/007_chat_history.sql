@@ -0,0 +1,26 @@
+-- Adds the index behind date ordered chat history, and drops the ORDER BY from messages_with_details:
+-- it forced a sort of the whole join even for queries filtering on one chat. Queries that relied on the
+-- view's order need their own ORDER BY.
+
+BEGIN;
+
+CREATE INDEX messages_chat_date_idx ON messages (chat_id, date, message_id);
+
+CREATE OR REPLACE VIEW messages_with_details AS
+SELECT
+    m.message_id,
+    m.text,
+    u.username,
+    c.title AS chat_title,
+    m.date,
+    m.chat_id,
+    m.sender_id,
+    m.insertion_time
+FROM
+    messages m
+JOIN
+    users u ON m.sender_id = u.user_id
+JOIN
+    chats c ON m.chat_id = c.chat_id;
+
+COMMIT;
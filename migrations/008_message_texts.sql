@@ -0,0 +1,36 @@
+-- Adds content-addressed storage for message texts (TEXT_STORAGE=dedup): each distinct body is kept once in
+-- message_texts and messages only reference it by hash. text_search stops being generated because the
+-- text may no longer be in the row; DatabaseManager computes it on insert, and existing values are kept.
+-- With TEXT_STORAGE=dedup, DatabaseManager also switches message_texts.text to lz4 compression at startup
+-- when the server supports it (PostgreSQL 14+ built with lz4).
+
+BEGIN;
+
+CREATE TABLE message_texts (
+    text_hash BYTEA PRIMARY KEY,
+    text TEXT NOT NULL
+);
+
+ALTER TABLE messages ADD COLUMN text_hash BYTEA;
+ALTER TABLE messages ALTER COLUMN text_search DROP EXPRESSION;
+
+CREATE OR REPLACE VIEW messages_with_details AS
+SELECT
+    m.message_id,
+    COALESCE(m.text, t.text) AS text,
+    u.username,
+    c.title AS chat_title,
+    m.date,
+    m.chat_id,
+    m.sender_id,
+    m.insertion_time
+FROM
+    messages m
+LEFT JOIN
+    message_texts t ON m.text_hash = t.text_hash
+JOIN
+    users u ON m.sender_id = u.user_id
+JOIN
+    chats c ON m.chat_id = c.chat_id;
+
+COMMIT;
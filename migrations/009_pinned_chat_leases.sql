@@ -0,0 +1,14 @@
+-- Pins the leases of private chats and basic groups to the session that claimed them: their message ids
+-- are per account, so another session can't carry on their backfill or store their messages next to the
+-- first one's. Pinned leases never expire and are never rebalanced.
+
+BEGIN;
+
+ALTER TABLE chat_leases ADD COLUMN pinned BOOLEAN NOT NULL DEFAULT false;
+
+UPDATE chat_leases l
+SET pinned = true
+FROM chats c
+WHERE c.chat_id = l.chat_id AND NOT c.is_channel;
+
+COMMIT;
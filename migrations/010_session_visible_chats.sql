@@ -0,0 +1,8 @@
+-- Records the channels and supergroups each ingest session can see, so sessions only hand leases over to
+-- sessions that can actually pick them up.
+
+BEGIN;
+
+ALTER TABLE ingest_sessions ADD COLUMN visible_chat_ids BIGINT[] NOT NULL DEFAULT '{}';
+
+COMMIT;
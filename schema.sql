@@ -18,17 +18,31 @@ CREATE TABLE chats (
     is_user BOOLEAN
 );
 
+-- Partitioned by month on date. DatabaseManager creates the monthly partitions (messages_pYYYY_MM)
+-- as needed; messages_default only catches rows whose partition couldn't be created.
 CREATE TABLE messages (
     message_id BIGINT,
     sender_id BIGINT,
     chat_id BIGINT,
     text TEXT,
-    date TIMESTAMP,
+    date TIMESTAMP NOT NULL,
     is_historical BOOLEAN,
     insertion_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    PRIMARY KEY (chat_id, message_id),
+    -- Set instead of text when the text is stored in message_texts
+    text_hash BYTEA,
+    -- Written by DatabaseManager, since the text may live in message_texts
+    text_search TSVECTOR,
+    PRIMARY KEY (chat_id, message_id, date),
     FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
-);
+) PARTITION BY RANGE (date);
+
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+CREATE INDEX messages_text_search_idx ON messages USING GIN (text_search);
+CREATE INDEX messages_date_idx ON messages (date);
+CREATE INDEX messages_insertion_time_idx ON messages (insertion_time);
+-- History by date within a chat; history by message id uses the primary key
+CREATE INDEX messages_chat_date_idx ON messages (chat_id, date, message_id);
 
 CREATE TABLE chats_participants_count(
     id BIGSERIAL PRIMARY KEY,
@@ -38,18 +52,69 @@ CREATE TABLE chats_participants_count(
     FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
 );
 
+CREATE TABLE chats_sync_state (
+    chat_id BIGINT PRIMARY KEY,
+    latest_message_id BIGINT,
+    historical_message_id BIGINT,
+    historical_message_date TIMESTAMP,
+    historical_message_count BIGINT NOT NULL DEFAULT 0,
+    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+);
+
+-- Message id ranges (start_id, end_id] of large chats being backfilled concurrently. progress_id is the
+-- newest message stored for the range; rows are removed once every range of the chat is complete.
+CREATE TABLE historical_segments (
+    chat_id BIGINT,
+    start_id BIGINT,
+    end_id BIGINT NOT NULL,
+    progress_id BIGINT NOT NULL,
+    PRIMARY KEY (chat_id, start_id),
+    FOREIGN KEY (chat_id) REFERENCES chats(chat_id)
+);
+
+-- Ingest sessions (Telegram accounts) and the chats each one owns. The owner backfills the chat and
+-- stores the messages whose ids are only meaningful per account (private chats and basic groups).
+-- Leases are renewed while the session is alive, so a crashed session's chats are taken over once
+-- they expire.
+CREATE TABLE ingest_sessions (
+    session TEXT PRIMARY KEY,
+    heartbeat_time TIMESTAMP NOT NULL,
+    -- Channels and supergroups the session can see, leases are only handed over to sessions that see the chat
+    visible_chat_ids BIGINT[] NOT NULL DEFAULT '{}'
+);
+
+CREATE TABLE chat_leases (
+    chat_id BIGINT PRIMARY KEY,
+    session TEXT NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    -- Private chats and basic groups stay with the session that claimed them, their message ids are per account
+    pinned BOOLEAN NOT NULL DEFAULT false
+);
+
+CREATE INDEX chat_leases_session_idx ON chat_leases (session);
+
+-- Message texts stored once per distinct body, keyed by SHA-256, when TEXT_STORAGE=dedup. DatabaseManager
+-- switches text to lz4 compression at startup in that mode, when the server supports it.
+CREATE TABLE message_texts (
+    text_hash BYTEA PRIMARY KEY,
+    text TEXT NOT NULL
+);
+
 CREATE VIEW messages_with_details AS
 SELECT
     m.message_id,
-    m.text,
+    COALESCE(m.text, t.text) AS text,
     u.username,
     c.title AS chat_title,
-    m.date
+    m.date,
+    m.chat_id,
+    m.sender_id,
+    m.insertion_time
 FROM
     messages m
+LEFT JOIN
+    message_texts t ON m.text_hash = t.text_hash
 JOIN
     users u ON m.sender_id = u.user_id
 JOIN
-    chats c ON m.chat_id = c.chat_id
-ORDER BY
-    m.date DESC;
+    chats c ON m.chat_id = c.chat_id;
@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+
+class EntityCache:
+    # Bounded LRU of entity id -> content hash, used to drop rows that are already stored unchanged
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def check_and_update(self, key, digest):
+        # Returns True if the entity is already stored with this content, otherwise records it
+        if self._entries.get(key) == digest:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+        self.misses += 1
+        self._entries[key] = digest
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return False
+
+    def invalidate(self, keys):
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+class LookupCache:
+    # Bounded LRU of key -> value whose entries expire after ttl seconds, for values resolved over the network
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        if (entry := self._entries.get(key)) is None:
+            return None
+        value, expiry_time = entry
+        if time.monotonic() >= expiry_time:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -1,168 +1,1004 @@
 import asyncpg
 import asyncio
 import logging
-from dataclasses import dataclass
-from datetime import datetime
+import time
+from typing import NamedTuple
+from datetime import datetime, date, timezone
 
 from telethon import events, types
 from telethon.tl import patched
 
 from .utils import get_username
+from .cache import EntityCache
+from .metrics import INSERT_BUFFER_ROWS, BATCH_ROWS, FLUSH_DURATION, ROWS_DROPPED, ROWS_EXPIRED, ENTITY_CACHE_LOOKUPS, SPOOLED_ROWS, SPOOL_SEGMENTS
 
 class DatabaseManager:
 
     def __init__(self, dsn):
         self.dsn = dsn
+        # Writes and reads use separate pools, so slow searches or scheduler queries never hold up a flush
         self.pool = None
-        self._insert_queue = asyncio.Queue()
+        self.read_pool = None
+        self.write_pool_size = 6
+        self.read_pool_size = 6
+        self.batch_size = 1000
         self.batch_wait_time = 1
+        self.max_buffered_rows = 20000
+        self._buffers = {row_type: RowBuffer(self.max_buffered_rows) for row_type in FLUSH_ORDER}
+        self.entity_cache_size = 100000
+        self.entity_cache = EntityCache(self.entity_cache_size)
+        self._pending_event = asyncio.Event()
+        self._full_event = asyncio.Event()
+        self._flush_callbacks = []
+        self.spool = None
+        self.spool_retry_wait_time = 5
+        self._spool_retry_time = 0
+        self.insert_mode = 'executemany' # or 'copy'
+        self.text_storage = 'inline' # or 'dedup'
+        self.text_dedup_min_bytes = 64
+        self.partition_months_ahead = 3
+        self.retention_months = None
+        self.retention_policy = 'detach' # or 'archive'
+        self.partition_lock_timeout = 5
+        self.maintenance_wait_time = 3600
+        self._partitions = set()
         self.stop_event = asyncio.Event()
         self.logger = logging.getLogger('database')
 
+        INSERT_BUFFER_ROWS.set_function(lambda: {(row_type.__name__,): len(buffer) for row_type, buffer in self._buffers.items()})
+        ENTITY_CACHE_LOOKUPS.set_function(lambda: {('hit',): self.entity_cache.hits, ('miss',): self.entity_cache.misses})
+        SPOOL_SEGMENTS.set_function(lambda: len(self.spool.segments) if self.spool else 0)
+
     async def run(self):
-        self.pool = await asyncpg.create_pool(self.dsn)
-        while True:
+        if self.pool is None:
+            self.pool = await asyncpg.create_pool(self.dsn, min_size=2, max_size=self.write_pool_size, connection_class=WriterConnection)
+        if self.read_pool is None:
+            self.read_pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.read_pool_size)
+        await self.load_partitions()
+        if self.text_storage == 'dedup':
+            await self.enable_text_compression()
+        maintenance_task = asyncio.create_task(self.maintenance_loop())
+        while not self.stop_event.is_set():
+            if self.spool is not None and self.spool.has_pending():
+                # Keep waking up to retry the replay even if nothing new is queued
+                self._pending_event.set()
+            await self.wait_for_batch()
             await self.batch_insert_from_queue()
-            await self.sleep()
+        await self.batch_insert_from_queue()
+        maintenance_task.cancel()
+
+    async def maintenance_loop(self):
+        while True:
+            try:
+                await self.maintain_partitions()
+            except TRANSIENT_ERRORS as e:
+                self.logger.error(f'Database unavailable during partition maintenance: {e!r}')
+            await asyncio.sleep(self.maintenance_wait_time)
 
     def stop(self):
         self.stop_event.set()
+        self._pending_event.set()
+        self._full_event.set()
 
     async def get_latest_historical_message(self, chat_id):
-        async with self.pool.acquire() as conn:
+        async with self.read_pool.acquire() as conn:
             try:
                 row = await conn.fetchrow("""
                     SELECT
-                        message_id, date
-                    FROM messages
-                    WHERE chat_id = $1 AND is_historical = true
-                    ORDER BY message_id DESC
-                    LIMIT 1
+                        historical_message_id AS message_id,
+                        historical_message_date AS date
+                    FROM chats_sync_state
+                    WHERE chat_id = $1 AND historical_message_id IS NOT NULL
                 """, chat_id)
                 return row
             except asyncpg.PostgresError as e:
-                self.logger.error(f'PostgreSQL error during query on chats table: {e}')
+                self.logger.error(f'PostgreSQL error during query on chats_sync_state table: {e}')
 
     async def get_all_latest_message_ids(self):
-        async with self.pool.acquire() as conn:
+        async with self.read_pool.acquire() as conn:
             try:
                 return await conn.fetch('''
                     SELECT
                         chat_id,
-                        MAX(message_id) AS latest_message_id,
-                        MAX(CASE WHEN is_historical THEN message_id ELSE NULL END) AS latest_historical_message_id
-                    FROM messages
-                    GROUP BY chat_id
+                        latest_message_id,
+                        historical_message_id AS latest_historical_message_id
+                    FROM chats_sync_state
                 ''')
+            except TRANSIENT_ERRORS:
+                raise
             except asyncpg.PostgresError as e:
-                self.logger.error(f'PostgreSQL error during query on chats table: {e}')
+                self.logger.error(f'PostgreSQL error during query on chats_sync_state table: {e}')
 
     async def get_historical_message_count(self, chat_id):
-        async with self.pool.acquire() as conn:
+        async with self.read_pool.acquire() as conn:
             try:
                 row = await conn.fetchrow('''
-                    SELECT COUNT(*) AS count
-                    FROM messages
-                    WHERE chat_id = $1 AND is_historical = true
+                    SELECT historical_message_count AS count
+                    FROM chats_sync_state
+                    WHERE chat_id = $1
                 ''', chat_id)
-                return row['count']
+                return row['count'] if row else 0
             except asyncpg.PostgresError as e:
-                self.logger.error(f'PostgreSQL error during query on messages table: {e}')
+                self.logger.error(f'PostgreSQL error during query on chats_sync_state table: {e}')
 
-    async def get_chat_title(self, chat_id):
+    async def get_historical_segments(self, chat_id):
+        async with self.read_pool.acquire() as conn:
+            try:
+                return await conn.fetch("""
+                    SELECT start_id, end_id, progress_id
+                    FROM historical_segments
+                    WHERE chat_id = $1
+                    ORDER BY start_id
+                """, chat_id)
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during query on historical_segments table: {e}')
+                return []
+
+    async def create_historical_segments(self, chat_id, segments):
+        # Written directly rather than through the buffers: the segments must exist before any of
+        # their messages are, or the writer would move the watermark past the unfetched ranges
+        async with self.pool.acquire() as conn:
+            await conn.executemany("""
+                INSERT INTO historical_segments (chat_id, start_id, end_id, progress_id)
+                VALUES ($1, $2, $3, $2)
+                ON CONFLICT (chat_id, start_id) DO NOTHING
+            """, [(chat_id, start_id, end_id) for start_id, end_id in segments])
+
+    async def renew_chat_leases(self, session, duration, visible_chat_ids):
+        # Records the session's heartbeat and the shared chats it can see, and extends its unexpired leases.
+        # Returns the chats it still holds, pinned ones included, and for each visible chat the number of
+        # live sessions that can see it, this one included.
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    await conn.execute("""
+                        INSERT INTO ingest_sessions (session, heartbeat_time, visible_chat_ids)
+                        VALUES ($1, LOCALTIMESTAMP, $2)
+                        ON CONFLICT (session) DO UPDATE SET
+                            heartbeat_time = EXCLUDED.heartbeat_time,
+                            visible_chat_ids = EXCLUDED.visible_chat_ids
+                    """, session, list(visible_chat_ids))
+                    rows = await conn.fetch("""
+                        UPDATE chat_leases
+                        SET expires_at = LOCALTIMESTAMP + $2::interval
+                        WHERE session = $1 AND (expires_at >= LOCALTIMESTAMP OR pinned)
+                        RETURNING chat_id
+                    """, session, duration)
+                    viewers = await conn.fetch("""
+                        SELECT v.chat_id, COUNT(*) AS sessions
+                        FROM ingest_sessions s, unnest(s.visible_chat_ids) AS v (chat_id)
+                        WHERE s.heartbeat_time >= LOCALTIMESTAMP - $1::interval AND v.chat_id = ANY($2::bigint[])
+                        GROUP BY v.chat_id
+                    """, duration, list(visible_chat_ids))
+                return {row['chat_id'] for row in rows}, {row['chat_id']: row['sessions'] for row in viewers}
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                # The caller keeps its current leases
+                self.logger.error(f'PostgreSQL error during chat_leases renewal: {e}')
+                return None
+
+    async def claim_chat_leases(self, session, chat_ids, duration, limit=None):
+        # Takes up to `limit` of the given chats that nobody holds or whose lease expired, and returns them.
+        # Concurrent claims on the same chat resolve through the primary key, so only one session wins.
+        async with self.pool.acquire() as conn:
+            try:
+                rows = await conn.fetch("""
+                    WITH candidates AS (
+                        SELECT c.chat_id
+                        FROM unnest($2::bigint[]) AS c (chat_id)
+                        LEFT JOIN chat_leases l ON l.chat_id = c.chat_id
+                        WHERE l.chat_id IS NULL OR (l.expires_at < LOCALTIMESTAMP AND NOT l.pinned)
+                        LIMIT $4
+                    )
+                    INSERT INTO chat_leases (chat_id, session, expires_at)
+                    SELECT chat_id, $1, LOCALTIMESTAMP + $3::interval
+                    FROM candidates
+                    ON CONFLICT (chat_id) DO UPDATE SET session = EXCLUDED.session, expires_at = EXCLUDED.expires_at
+                    WHERE chat_leases.expires_at < LOCALTIMESTAMP AND NOT chat_leases.pinned
+                    RETURNING chat_id
+                """, session, list(chat_ids), duration, limit)
+                return {row['chat_id'] for row in rows}
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during chat_leases claim: {e}')
+                return set()
+
+    async def claim_pinned_chat_leases(self, session, chat_ids):
+        # Takes the given chats that have never been leased, for good. Returns the ones claimed.
+        async with self.pool.acquire() as conn:
+            try:
+                rows = await conn.fetch("""
+                    INSERT INTO chat_leases (chat_id, session, expires_at, pinned)
+                    SELECT chat_id, $1, LOCALTIMESTAMP, true
+                    FROM unnest($2::bigint[]) AS c (chat_id)
+                    ON CONFLICT (chat_id) DO NOTHING
+                    RETURNING chat_id
+                """, session, list(chat_ids))
+                return {row['chat_id'] for row in rows}
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during chat_leases claim: {e}')
+                return set()
+
+    async def release_chat_leases(self, session, chat_ids):
         async with self.pool.acquire() as conn:
+            try:
+                await conn.execute("""
+                    DELETE FROM chat_leases
+                    WHERE session = $1 AND chat_id = ANY($2::bigint[]) AND NOT pinned
+                """, session, list(chat_ids))
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during chat_leases release: {e}')
+
+    async def get_chat_title(self, chat_id):
+        async with self.read_pool.acquire() as conn:
             try:
                 row = await conn.fetchrow("""
                     SELECT title
                     FROM chats
                     WHERE chat_id = $1
                 """, chat_id)
-                return row['title']
+                return row['title'] if row else None
             except asyncpg.PostgresError as e:
                 self.logger.error(f'PostgreSQL error during query on chats table: {e}')
 
-    async def sleep(self):
-        await asyncio.sleep(self.batch_wait_time)
-        # tasks = [asyncio.create_task(asyncio.sleep(delay)), asyncio.create_task(self.stop_event.wait())]
-        # done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-        # await done
-        # for task in pending:
-        #     task.cancel()
+    async def search_messages(self, query, chat_id=None, sender_id=None, since=None, until=None, order='rank', after=None, limit=50):
+        # Full-text search over messages.text_search with keyset pagination. Results are ordered by
+        # rank or by date (newest first); pass the returned cursor as `after` to get the next page.
+        conditions = ["m.text_search @@ websearch_to_tsquery('simple', $1)"]
+        args = [query]
+        for condition, value in (('m.chat_id = ${}', chat_id), ('m.sender_id = ${}', sender_id), ('m.date >= ${}', since), ('m.date < ${}', until)):
+            if value is not None:
+                args.append(value)
+                conditions.append(condition.format(len(args)))
+        if order == 'rank':
+            sort_key = 'rank'
+            cursor_type = 'real'
+        elif order == 'date':
+            sort_key = 'date'
+            cursor_type = 'timestamp'
+        else:
+            raise ValueError(f'Unknown search order {order!r}')
+        keyset_condition = ''
+        if after is not None:
+            args.extend(after)
+            keyset_condition = f'WHERE ({sort_key}, chat_id, message_id) < (${len(args) - 2}::{cursor_type}, ${len(args) - 1}, ${len(args)})'
+        args.append(limit)
+        async with self.read_pool.acquire() as conn:
+            try:
+                rows = await conn.fetch(f"""
+                    SELECT *
+                    FROM (
+                        SELECT
+                            m.chat_id,
+                            m.message_id,
+                            m.sender_id,
+                            COALESCE(m.text, t.text) AS text,
+                            m.date,
+                            u.username,
+                            c.title AS chat_title,
+                            ts_rank(m.text_search, websearch_to_tsquery('simple', $1)) AS rank
+                        FROM messages m
+                        LEFT JOIN message_texts t ON t.text_hash = m.text_hash
+                        LEFT JOIN users u ON u.user_id = m.sender_id
+                        LEFT JOIN chats c ON c.chat_id = m.chat_id
+                        WHERE {' AND '.join(conditions)}
+                    ) matches
+                    {keyset_condition}
+                    ORDER BY {sort_key} DESC, chat_id DESC, message_id DESC
+                    LIMIT ${len(args)}
+                """, *args)
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during search on messages table: {e}')
+                return [], None
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = (last[sort_key], last['chat_id'], last['message_id'])
+        return rows, next_cursor
+
+    async def get_chat_history(self, chat_id, order='id', direction='backward', after=None, since=None, until=None, limit=100):
+        # A page of one chat's messages, keyset paginated on message_id or on (date, message_id). Backward
+        # pages go newest first, forward pages oldest first; pass the returned cursor as `after` for the
+        # next page. The page is cut before joining users and chats, so each call costs a short index range
+        # scan per partition whatever the size of the table.
+        if order == 'id':
+            sort_keys = ['message_id']
+        elif order == 'date':
+            sort_keys = ['date', 'message_id']
+        else:
+            raise ValueError(f'Unknown history order {order!r}')
+        if direction == 'backward':
+            comparison, sort_direction = '<', 'DESC'
+        elif direction == 'forward':
+            comparison, sort_direction = '>', 'ASC'
+        else:
+            raise ValueError(f'Unknown history direction {direction!r}')
+        conditions = ['chat_id = $1']
+        args = [chat_id]
+        for condition, value in (('date >= ${}', since), ('date < ${}', until)):
+            if value is not None:
+                args.append(value)
+                conditions.append(condition.format(len(args)))
+        if after is not None:
+            after = (after,) if order == 'id' else tuple(after)
+            args.extend(after)
+            placeholders = ', '.join(f'${len(args) - len(after) + 1 + i}' for i in range(len(after)))
+            conditions.append(f"({', '.join(sort_keys)}) {comparison} ({placeholders})")
+        args.append(limit)
+        order_by = ', '.join(f'{key} {sort_direction}' for key in sort_keys)
+        async with self.read_pool.acquire() as conn:
+            try:
+                rows = await conn.fetch(f"""
+                    WITH page AS (
+                        SELECT chat_id, message_id, sender_id, text, text_hash, date, is_historical
+                        FROM messages
+                        WHERE {' AND '.join(conditions)}
+                        ORDER BY {order_by}
+                        LIMIT ${len(args)}
+                    )
+                    SELECT
+                        page.chat_id,
+                        page.message_id,
+                        page.sender_id,
+                        COALESCE(page.text, t.text) AS text,
+                        page.date,
+                        page.is_historical,
+                        u.username,
+                        u.first_name,
+                        u.last_name,
+                        c.title AS chat_title
+                    FROM page
+                    LEFT JOIN message_texts t ON t.text_hash = page.text_hash
+                    LEFT JOIN users u ON u.user_id = page.sender_id
+                    LEFT JOIN chats c ON c.chat_id = page.chat_id
+                    ORDER BY {', '.join(f'page.{key} {sort_direction}' for key in sort_keys)}
+                """, *args)
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during history query on messages table: {e}')
+                return [], None
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = last['message_id'] if order == 'id' else (last['date'], last['message_id'])
+        return rows, next_cursor
 
-    async def queue_insert(self, item):
-        if item is not None:
-            await self._insert_queue.put(item)
+    async def get_messages_since(self, since, after=None, until=None, limit=500):
+        # Messages dated from `since` onwards, up to `until` included, in (date, chat_id, message_id) order.
+        # `after` is a key of that form used for keyset pagination.
+        conditions = ['m.date >= $1']
+        args = [since]
+        if after is not None:
+            args.extend(after)
+            conditions.append(f'(m.date, m.chat_id, m.message_id) > (${len(args) - 2}, ${len(args) - 1}, ${len(args)})')
+        if until is not None:
+            args.append(until)
+            conditions.append(f'm.date <= ${len(args)}')
+        args.append(limit)
+        async with self.read_pool.acquire() as conn:
+            try:
+                return await conn.fetch(f"""
+                    SELECT
+                        m.chat_id,
+                        m.message_id,
+                        m.sender_id,
+                        COALESCE(m.text, t.text) AS text,
+                        m.date,
+                        u.username,
+                        u.first_name,
+                        u.last_name,
+                        c.title AS chat_title
+                    FROM messages m
+                    LEFT JOIN message_texts t ON t.text_hash = m.text_hash
+                    LEFT JOIN users u ON u.user_id = m.sender_id
+                    LEFT JOIN chats c ON c.chat_id = m.chat_id
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY m.date, m.chat_id, m.message_id
+                    LIMIT ${len(args)}
+                """, *args)
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during query on messages table: {e}')
+                return []
+
+    async def load_partitions(self):
+        async with self.pool.acquire() as conn:
+            try:
+                rows = await conn.fetch("""
+                    SELECT c.relname
+                    FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'messages'::regclass
+                """)
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during query on messages partitions: {e}')
+                return
+        for row in rows:
+            if month := month_from_partition_name(row['relname']):
+                self._partitions.add(month)
+
+    async def enable_text_compression(self):
+        # Optional: lz4 needs PostgreSQL 14+ built with it, deduplication works the same without it
+        async with self.pool.acquire() as conn:
+            try:
+                compression = await conn.fetchval("""
+                    SELECT attcompression
+                    FROM pg_attribute
+                    WHERE attrelid = 'message_texts'::regclass AND attname = 'text'
+                """)
+                if compression != 'l':
+                    await conn.execute('ALTER TABLE message_texts ALTER COLUMN text SET COMPRESSION lz4')
+                    self.logger.info('Enabled lz4 compression of message_texts')
+            except asyncpg.PostgresError as e:
+                self.logger.warning(f'Keeping the default compression of message_texts: {e}')
+
+    async def ensure_partitions(self, conn, months):
+        # Monthly partitions are created on demand, before the first row for that month is written.
+        # Rows only end up in messages_default if creating their partition failed.
+        for month in sorted(set(months) - self._partitions):
+            name = partition_name(month)
+            try:
+                # Attaching only takes a SHARE UPDATE EXCLUSIVE lock on messages, where PARTITION OF takes an
+                # ACCESS EXCLUSIVE one. The lock timeout keeps the flush from queueing behind long readers
+                # holding messages_default; the batch is retried instead.
+                async with conn.transaction():
+                    await conn.execute(f"SET LOCAL lock_timeout = {int(self.partition_lock_timeout * 1000)}")
+                    await conn.execute(f'CREATE TABLE {name} (LIKE messages INCLUDING ALL)')
+                    await conn.execute(f"""
+                        ALTER TABLE messages ATTACH PARTITION {name}
+                        FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')
+                    """)
+                self._partitions.add(month)
+                self.logger.info(f'Created partition {name}')
+            except asyncpg.DuplicateTableError:
+                if await self.is_partition(conn, name):
+                    # Created by another writer in the meantime
+                    self._partitions.add(month)
+                else:
+                    self.logger.error(f'Table {name} exists but is not a partition of messages (retired?), rename or drop it')
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during creation of partition {name}: {e}')
+
+    async def is_partition(self, conn, name):
+        return await conn.fetchval("""
+            SELECT EXISTS (
+                SELECT 1
+                FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'messages'::regclass AND c.relname = $1
+            )
+        """, name)
+
+    def get_retention_cutoff(self):
+        # First month kept; partitions and rows of earlier months are retired
+        if self.retention_months is not None:
+            return add_months(month_start(datetime.now(timezone.utc)), -self.retention_months)
+
+    async def maintain_partitions(self):
+        current_month = month_start(datetime.now(timezone.utc))
+        cutoff = self.get_retention_cutoff()
+        # With a retention period the whole window is created ahead of time, so backfill rarely has to
+        # create partitions from the flush
+        first_month = cutoff or current_month
+        months_ahead = (current_month.year - first_month.year) * 12 + current_month.month - first_month.month + self.partition_months_ahead
+        async with self.pool.acquire() as conn:
+            await self.ensure_partitions(conn, [add_months(first_month, i) for i in range(months_ahead + 1)])
+            if cutoff is None:
+                return
+            for month in sorted(self._partitions):
+                if add_months(month, 1) > cutoff:
+                    break
+                if not await self.retire_partition(conn, month):
+                    # The later months would wait on the same lock
+                    break
+
+    async def retire_partition(self, conn, month):
+        # 'detach' leaves the partition as a standalone table, 'archive' also moves it into the archive schema
+        name = partition_name(month)
+        try:
+            async with conn.transaction():
+                # Detaching takes an ACCESS EXCLUSIVE lock on messages. Queued behind a long reader, it would
+                # hold up every insert and read queued behind it in turn, so it gives up and waits for the
+                # next maintenance cycle instead.
+                await conn.execute(f"SET LOCAL lock_timeout = {int(self.partition_lock_timeout * 1000)}")
+                await conn.execute(f'ALTER TABLE messages DETACH PARTITION {name}')
+                if self.retention_policy == 'archive':
+                    await conn.execute('CREATE SCHEMA IF NOT EXISTS archive')
+                    await conn.execute(f'ALTER TABLE {name} SET SCHEMA archive')
+            self._partitions.discard(month)
+            self.logger.warning(f'Retired partition {name} ({self.retention_policy})')
+            return True
+        except asyncpg.LockNotAvailableError:
+            self.logger.warning(f'Partition {name} is in use, retiring it in the next maintenance cycle')
+            return False
+        except asyncpg.PostgresError as e:
+            self.logger.error(f'PostgreSQL error during retirement of partition {name}: {e}')
+            return True
+
+    async def wait_for_batch(self):
+        # Sleeps until a row is queued, then lets the batch fill up until it reaches batch_size rows
+        # or batch_wait_time seconds have passed, whichever comes first
+        await self._pending_event.wait()
+        try:
+            await asyncio.wait_for(self._full_event.wait(), self.batch_wait_time)
+        except asyncio.TimeoutError:
+            pass
+
+    async def queue_insert(self, item, on_flush=None):
+        # on_flush is called once the flush that picks up the row has been written to the database
+        if item is None:
+            return
+        if id_field := ENTITY_ID_FIELDS.get(type(item)):
+            # Users and chats are queued with nearly every message, skip the ones already stored unchanged
+            if self.entity_cache.check_and_update((type(item), getattr(item, id_field)), hash(item)):
+                return
+        buffer = self._buffers[type(item)]
+        # Backpressure: producers wait here while the writer is behind. Only while the database is failing
+        # do the rows go to the spool instead, so a database that is merely slower than Telegram throttles
+        # ingest rather than growing the spool.
+        while buffer.is_full():
+            if self.is_database_failing():
+                await self.spill_buffers()
+                break
+            await buffer.not_full.wait()
+        buffer.append(item)
+        if on_flush is not None:
+            self._flush_callbacks.append(on_flush)
+        self._pending_event.set()
+        if len(buffer) >= self.batch_size:
+            self._full_event.set()
+
+    def is_database_failing(self):
+        return self.spool is not None and (time.monotonic() < self._spool_retry_time or self.spool.has_pending())
+
+    async def wait_for_flush(self):
+        # Returns once everything queued so far has been written. Never returns if that flush goes to the
+        # spool or is dropped, so callers bound the wait.
+        flushed = asyncio.get_running_loop().create_future()
+        self._flush_callbacks.append(lambda: flushed.done() or flushed.set_result(None))
+        self._pending_event.set()
+        await flushed
 
     async def batch_insert_from_queue(self):
-        users = []
-        chats = []
-        messages = []
-        chats_participants_count = []
-        while not self._insert_queue.empty():
-            item =  await self._insert_queue.get()
-            if isinstance(item, UserRow):
-                users.append(item)
-            elif isinstance(item, ChatRow):
-                chats.append(item)
-            elif isinstance(item, MessageRow):
-                messages.append(item)
-            elif isinstance(item, ChatParticipantsCountRow):
-                chats_participants_count.append(item)
-        if users:
-            await self.batch_insert_users(users)
-        if chats:
-            await self.batch_insert_chats(chats)
-        if messages:
-            await self.batch_insert_messages(messages)
-        if chats_participants_count:
-            await self.batch_insert_chats_participants_count(chats_participants_count)
-
-    async def batch_insert_users(self, users: list['UserRow']):
+        self._pending_event.clear()
+        self._full_event.clear()
+        batches = {row_type: self._buffers[row_type].drain() for row_type in FLUSH_ORDER}
+        flush_callbacks, self._flush_callbacks = self._flush_callbacks, []
+        if self.spool is not None and self.spool.has_pending():
+            await self.replay_spool()
+        # Once anything is spooled, newer rows follow it there so they are written in order
+        spilling = self.spool is not None and self.spool.has_pending()
+        for stage in FLUSH_STAGES:
+            stage_batches = [(row_type, batches[row_type]) for row_type in stage if batches[row_type]]
+            if spilling:
+                for row_type, rows in stage_batches:
+                    await self.spool_rows(row_type, rows)
+                continue
+            # Tables in a stage don't reference each other, so they are written concurrently on separate connections
+            results = await asyncio.gather(*(self.timed_batch_insert(row_type, rows) for row_type, rows in stage_batches), return_exceptions=True)
+            for (row_type, rows), result in zip(stage_batches, results):
+                if not isinstance(result, BaseException):
+                    continue
+                if not isinstance(result, TRANSIENT_ERRORS):
+                    raise result
+                self.logger.error(f'Database unavailable during {TABLES[row_type]} insertion: {result!r}')
+                self._spool_retry_time = time.monotonic() + self.spool_retry_wait_time
+                if self.spool is None:
+                    self.drop_rows(row_type, rows)
+                    flush_callbacks.clear()
+                    continue
+                spilling = True
+                await self.spool_rows(row_type, rows)
+        if not spilling:
+            for callback in flush_callbacks:
+                callback()
+
+    async def timed_batch_insert(self, row_type, rows):
+        table = TABLES[row_type]
+        start = time.perf_counter()
+        await getattr(self, f'batch_insert_{table}')(rows)
+        FLUSH_DURATION.observe(time.perf_counter() - start, table=table)
+        BATCH_ROWS.observe(len(rows), table=table)
+
+    def drop_rows(self, row_type, rows):
+        ROWS_DROPPED.inc(len(rows), table=TABLES[row_type])
+        if id_field := ENTITY_ID_FIELDS.get(row_type):
+            self.entity_cache.invalidate((row_type, getattr(row, id_field)) for row in rows)
+
+    async def spool_rows(self, row_type, rows):
+        await self.spool.append(row_type.__name__, [tuple(row) for row in rows])
+        SPOOLED_ROWS.inc(len(rows), table=TABLES[row_type])
+
+    async def spill_buffers(self):
+        # All buffers go to the spool together and in flush order, so spooled messages never end up
+        # ahead of the chats they reference
+        self.logger.warning('Insert buffers are full, spilling them to the spool')
+        for row_type in FLUSH_ORDER:
+            if rows := self._buffers[row_type].drain():
+                await self.spool_rows(row_type, rows)
+        self._pending_event.set()
+
+    async def replay_spool(self):
+        if time.monotonic() < self._spool_retry_time:
+            return
+        try:
+            await self.spool.replay(self.insert_spooled_batch)
+        except TRANSIENT_ERRORS as e:
+            self.logger.warning(f'Database still unavailable, keeping rows spooled: {e!r}')
+            self._spool_retry_time = time.monotonic() + self.spool_retry_wait_time
+
+    async def insert_spooled_batch(self, kind, records):
+        row_type = ROW_TYPES[kind]
+        await self.timed_batch_insert(row_type, [row_type._make(record) for record in records])
+
+    async def copy_and_merge(self, conn, table, columns, records, merge_query):
+        # Streams records into a per-connection temporary staging table and merges them into the
+        # destination table with a single statement
+        staging_table = f'staging_{table}'
+        async with conn.transaction():
+            await conn.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {staging_table} ON COMMIT DELETE ROWS
+                AS SELECT {', '.join(columns)} FROM {table} WITH NO DATA
+            """)
+            await conn.copy_records_to_table(staging_table, records=records, columns=columns)
+            await conn.execute(merge_query.format(staging_table=staging_table))
+
+    async def batch_insert_users(self, users: list['UserRow'], insert_mode=None):
+        # Keep only the latest version of each user, a single upsert can't touch the same row twice
+        users = records = list({row.user_id: row for row in users}.values())
         async with self.pool.acquire() as conn:
             try:
-                await conn.executemany("""
-                    INSERT INTO users (user_id, username, first_name, last_name, is_bot, is_premium, is_scam, is_fake, is_verified)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                    ON CONFLICT (user_id) DO NOTHING
-                """, [(row.user_id, row.username, row.first_name, row.last_name, row.is_bot, row.is_premium, row.is_scam, row.is_fake, row.is_verified) for row in users])
+                if (insert_mode or self.insert_mode) == 'copy':
+                    await self.copy_and_merge(conn, 'users', USERS_COLUMNS, records, """
+                        INSERT INTO users (user_id, username, first_name, last_name, is_bot, is_premium, is_scam, is_fake, is_verified)
+                        SELECT user_id, username, first_name, last_name, is_bot, is_premium, is_scam, is_fake, is_verified
+                        FROM {staging_table}
+                    """ + UPSERT_USERS_CLAUSE)
+                else:
+                    await conn.executemany_prepared("""
+                        INSERT INTO users (user_id, username, first_name, last_name, is_bot, is_premium, is_scam, is_fake, is_verified)
+                        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                    """ + UPSERT_USERS_CLAUSE, records)
+            except TRANSIENT_ERRORS:
+                raise
             except asyncpg.PostgresError as e:
                 self.logger.error(f'PostgreSQL error during user insertion: {e}')
+                ROWS_DROPPED.inc(len(records), table='users')
+                self.entity_cache.invalidate((UserRow, row.user_id) for row in users)
 
-    async def batch_insert_chats(self, chats: list['ChatRow']):
+    async def batch_insert_chats(self, chats: list['ChatRow'], insert_mode=None):
+        chats = records = list({row.chat_id: row for row in chats}.values())
         async with self.pool.acquire() as conn:
             try:
-                await conn.executemany(f"""
-                    INSERT INTO chats (chat_id, title, is_group, is_channel, is_user)
-                    VALUES ($1, $2, $3, $4, $5)
-                    ON CONFLICT (chat_id) DO NOTHING
-                """, [(row.chat_id, row.title, row.is_group, row.is_channel, row.is_user) for row in chats])
+                if (insert_mode or self.insert_mode) == 'copy':
+                    await self.copy_and_merge(conn, 'chats', CHATS_COLUMNS, records, """
+                        INSERT INTO chats (chat_id, title, is_group, is_channel, is_user)
+                        SELECT chat_id, title, is_group, is_channel, is_user
+                        FROM {staging_table}
+                    """ + UPSERT_CHATS_CLAUSE)
+                else:
+                    await conn.executemany_prepared("""
+                        INSERT INTO chats (chat_id, title, is_group, is_channel, is_user)
+                        VALUES ($1, $2, $3, $4, $5)
+                    """ + UPSERT_CHATS_CLAUSE, records)
+            except TRANSIENT_ERRORS:
+                raise
             except asyncpg.PostgresError as e:
                 self.logger.error(f'PostgreSQL error during chat insertion: {e}')
+                ROWS_DROPPED.inc(len(records), table='chats')
+                self.entity_cache.invalidate((ChatRow, row.chat_id) for row in chats)
 
-    async def batch_insert_messages(self, messages: list['MessageRow']):
+    async def batch_insert_messages(self, messages: list['MessageRow'], insert_mode=None):
+        expired = []
+        if (cutoff := self.get_retention_cutoff()) is not None:
+            # Messages older than the retention period would end up in messages_default, since their
+            # partitions are retired, so they are skipped
+            expired = [row for row in messages if month_start(row.date) < cutoff]
+            if expired:
+                messages = [row for row in messages if month_start(row.date) >= cutoff]
+                ROWS_EXPIRED.inc(len(expired))
+        records = messages
         async with self.pool.acquire() as conn:
+            await self.ensure_partitions(conn, {month_start(row.date) for row in messages})
             try:
-                await conn.executemany("""
-                    INSERT INTO messages (message_id, sender_id, chat_id, text, date, is_historical)
-                    VALUES ($1, $2, $3, $4, $5, $6)
-                    ON CONFLICT (chat_id, message_id) DO UPDATE SET is_historical = EXCLUDED.is_historical
-                    WHERE messages.is_historical = false AND EXCLUDED.is_historical = true
-                """, [(row.message_id, row.sender_id, row.chat_id, row.text, row.date, row.is_historical) for row in messages])
+                if expired:
+                    await self.update_expired_messages_sync_state(conn, expired)
+                if not records:
+                    return
+                if (insert_mode or self.insert_mode) == 'copy':
+                    # A single INSERT can't update the same row twice, so duplicates in the batch are
+                    # collapsed first, preferring the historical copy
+                    await self.copy_and_merge(conn, 'messages', MESSAGES_COLUMNS, records, self.get_insert_messages_query("""(
+                        SELECT DISTINCT ON (chat_id, message_id) *
+                        FROM {staging_table}
+                        ORDER BY chat_id, message_id, is_historical DESC
+                    ) new"""))
+                else:
+                    # The batch goes in as arrays so the whole of it is one statement, and chats_sync_state
+                    # is updated once per chat rather than once per message
+                    await conn.execute_prepared(self.get_insert_messages_query("""(
+                        SELECT DISTINCT ON (chat_id, message_id) *
+                        FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::text[], $5::timestamp[], $6::boolean[])
+                            AS batch (message_id, sender_id, chat_id, text, date, is_historical)
+                        ORDER BY chat_id, message_id, is_historical DESC
+                    ) new"""), *map(list, zip(*records)))
+            except TRANSIENT_ERRORS:
+                raise
             except asyncpg.PostgresError as e:
                 self.logger.error(f'PostgreSQL error during message insertion: {e}')
+                ROWS_DROPPED.inc(len(records), table='messages')
 
-    async def batch_insert_chats_participants_count(self, chats_participants_count: list['ChatParticipantsCountRow']):
+    async def update_expired_messages_sync_state(self, conn, expired):
+        # Backfill still has to move past the skipped messages, or it would fetch them again forever
+        watermarks = {}
+        for row in expired:
+            if row.is_historical and row.message_id > watermarks.get(row.chat_id, (0, None))[0]:
+                watermarks[row.chat_id] = (row.message_id, row.date)
+        if not watermarks:
+            return
+        await conn.execute("""
+            INSERT INTO chats_sync_state (chat_id, historical_message_id, historical_message_date)
+            SELECT e.chat_id, e.message_id, e.date
+            FROM unnest($1::bigint[], $2::bigint[], $3::timestamp[]) AS e (chat_id, message_id, date)
+            -- Chats being backfilled in segments have their watermark moved by batch_insert_historical_segments instead
+            WHERE NOT EXISTS (SELECT 1 FROM historical_segments s WHERE s.chat_id = e.chat_id)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                historical_message_id = EXCLUDED.historical_message_id,
+                historical_message_date = EXCLUDED.historical_message_date
+            WHERE chats_sync_state.historical_message_id IS NULL OR chats_sync_state.historical_message_id < EXCLUDED.historical_message_id
+        """, list(watermarks), [message_id for message_id, _ in watermarks.values()], [date for _, date in watermarks.values()])
+
+    def get_insert_messages_query(self, source):
+        # `source` is a FROM item aliased `new` with the MESSAGES_COLUMNS. In dedup mode, texts of at least
+        # text_dedup_min_bytes are stored once in message_texts under their SHA-256 and messages only keep
+        # the hash; shorter ones stay inline, where the hash and index entry would cost more than they save.
+        # The search vector is computed here in both modes since the text may not be in the row.
+        if self.text_storage == 'dedup':
+            is_deduplicated = f'octet_length(new.text) >= {int(self.text_dedup_min_bytes)}'
+            text_hash = "sha256(convert_to(new.text, 'UTF8'))"
+            texts_query = f"""
+                texts AS (
+                    INSERT INTO message_texts (text_hash, text)
+                    SELECT {text_hash}, new.text
+                    FROM {source}
+                    WHERE {is_deduplicated}
+                    ON CONFLICT (text_hash) DO NOTHING
+                ),"""
+            text = f'CASE WHEN {is_deduplicated} THEN NULL ELSE new.text END'
+            text_hash = f'CASE WHEN {is_deduplicated} THEN {text_hash} END'
+        else:
+            texts_query, text, text_hash = '', 'new.text', 'NULL::bytea'
+        return f"""
+            WITH {texts_query} inserted AS (
+                INSERT INTO messages (message_id, sender_id, chat_id, text, text_hash, text_search, date, is_historical)
+                SELECT new.message_id, new.sender_id, new.chat_id, {text}, {text_hash}, to_tsvector('simple', coalesce(new.text, '')), new.date, new.is_historical
+                FROM {source}
+                ON CONFLICT (chat_id, message_id, date) DO UPDATE SET is_historical = EXCLUDED.is_historical
+                WHERE messages.is_historical = false AND EXCLUDED.is_historical = true
+                RETURNING chat_id, message_id, date, is_historical
+            )
+        """ + UPDATE_CHATS_SYNC_STATE_QUERY
+
+    async def batch_insert_chats_participants_count(self, chats_participants_count: list['ChatParticipantsCountRow'], insert_mode=None):
+        records = chats_participants_count
         async with self.pool.acquire() as conn:
             try:
-                await conn.executemany("""
-                    INSERT INTO chats_participants_count (chat_id, participants_count)
-                    VALUES ($1, $2)
-                """, [(row.chat_id, row.participants_count) for row in chats_participants_count])
+                if (insert_mode or self.insert_mode) == 'copy':
+                    # No conflict handling needed here, so the rows can be copied in directly
+                    await conn.copy_records_to_table('chats_participants_count', records=records, columns=CHATS_PARTICIPANTS_COUNT_COLUMNS)
+                else:
+                    await conn.executemany_prepared("""
+                        INSERT INTO chats_participants_count (chat_id, participants_count)
+                        VALUES ($1, $2)
+                    """, records)
+            except TRANSIENT_ERRORS:
+                raise
             except asyncpg.PostgresError as e:
                 self.logger.error(f'PostgreSQL error during chat_participants_count insertion: {e}')
+                ROWS_DROPPED.inc(len(records), table='chats_participants_count')
+
+    async def batch_insert_historical_segments(self, segments: list['HistoricalSegmentRow']):
+        # Flushed after messages, so recorded progress never runs ahead of the stored messages. The
+        # chat's watermark then moves up to the progress of its lowest unfinished segment, and once
+        # every segment is finished they are removed and the chat goes back to the regular watermark.
+        progress = {}
+        for row in segments:
+            key = (row.chat_id, row.start_id)
+            if key not in progress or row.progress_id > progress[key].progress_id:
+                progress[key] = row
+        records = list(progress.values())
+        chat_ids = list({row.chat_id for row in records})
+        async with self.pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    await conn.executemany_prepared("""
+                        INSERT INTO historical_segments (chat_id, start_id, end_id, progress_id)
+                        VALUES ($1, $2, $3, $4)
+                        ON CONFLICT (chat_id, start_id) DO UPDATE SET
+                            progress_id = GREATEST(historical_segments.progress_id, EXCLUDED.progress_id)
+                    """, records)
+                    await conn.execute("""
+                        WITH watermarks AS (
+                            SELECT
+                                chat_id,
+                                COALESCE(MIN(progress_id) FILTER (WHERE progress_id < end_id), MAX(end_id)) AS watermark
+                            FROM historical_segments
+                            WHERE chat_id = ANY($1::bigint[])
+                            GROUP BY chat_id
+                        )
+                        INSERT INTO chats_sync_state (chat_id, historical_message_id, historical_message_date)
+                        SELECT w.chat_id, w.watermark, (SELECT date FROM messages m WHERE m.chat_id = w.chat_id AND m.message_id = w.watermark)
+                        FROM watermarks w
+                        ON CONFLICT (chat_id) DO UPDATE SET
+                            historical_message_id = GREATEST(chats_sync_state.historical_message_id, EXCLUDED.historical_message_id),
+                            historical_message_date = CASE
+                                WHEN chats_sync_state.historical_message_id IS NULL OR EXCLUDED.historical_message_id > chats_sync_state.historical_message_id
+                                THEN EXCLUDED.historical_message_date
+                                ELSE chats_sync_state.historical_message_date
+                            END
+                    """, chat_ids)
+                    await conn.execute("""
+                        DELETE FROM historical_segments
+                        WHERE chat_id IN (
+                            SELECT chat_id
+                            FROM historical_segments
+                            WHERE chat_id = ANY($1::bigint[])
+                            GROUP BY chat_id
+                            HAVING bool_and(progress_id >= end_id)
+                        )
+                    """, chat_ids)
+            except TRANSIENT_ERRORS:
+                raise
+            except asyncpg.PostgresError as e:
+                self.logger.error(f'PostgreSQL error during historical_segments insertion: {e}')
+                ROWS_DROPPED.inc(len(records), table='historical_segments')
+
+class WriterConnection(asyncpg.Connection):
+    # Connections of the write pool prepare each insert statement once and keep it for their lifetime,
+    # instead of going through the statement cache on every flush
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = {}
+
+    async def executemany_prepared(self, query, args):
+        await self.run_prepared(query, lambda statement: statement.executemany(args))
+
+    async def execute_prepared(self, query, *args):
+        await self.run_prepared(query, lambda statement: statement.fetch(*args))
+
+    async def run_prepared(self, query, run):
+        if (statement := self.prepared_statements.get(query)) is None:
+            statement = self.prepared_statements[query] = await self.prepare(query)
+        try:
+            await run(statement)
+        except asyncpg.InvalidCachedStatementError:
+            # The table changed under the statement, prepare it again
+            statement = self.prepared_statements[query] = await self.prepare(query)
+            await run(statement)
+
+class RowBuffer:
+
+    def __init__(self, max_size):
+        self.rows = []
+        self.max_size = max_size
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def __len__(self):
+        return len(self.rows)
 
-@dataclass
-class MessageRow:
+    def is_full(self):
+        return len(self.rows) >= self.max_size
+
+    def append(self, row):
+        self.rows.append(row)
+        if self.is_full():
+            self.not_full.clear()
+
+    def drain(self):
+        rows, self.rows = self.rows, []
+        self.not_full.set()
+        return rows
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+def add_months(month, months):
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return date(year, month_index + 1, 1)
+
+def partition_name(month):
+    return f'messages_p{month:%Y_%m}'
+
+def month_from_partition_name(name):
+    try:
+        return datetime.strptime(name, 'messages_p%Y_%m').date()
+    except ValueError:
+        return None
+
+# Errors meaning the database couldn't be reached, as opposed to a problem with the rows themselves
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+    asyncpg.OperatorInterventionError,
+    # Lock timeouts while creating partitions, the batch is retried later
+    asyncpg.LockNotAvailableError,
+)
+
+USERS_COLUMNS = ['user_id', 'username', 'first_name', 'last_name', 'is_bot', 'is_premium', 'is_scam', 'is_fake', 'is_verified']
+CHATS_COLUMNS = ['chat_id', 'title', 'is_group', 'is_channel', 'is_user']
+MESSAGES_COLUMNS = ['message_id', 'sender_id', 'chat_id', 'text', 'date', 'is_historical']
+CHATS_PARTICIPANTS_COUNT_COLUMNS = ['chat_id', 'participants_count']
+HISTORICAL_SEGMENTS_COLUMNS = ['chat_id', 'start_id', 'end_id', 'progress_id']
+
+# Only rows whose content actually changed are rewritten
+UPSERT_USERS_CLAUSE = """
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        last_name = EXCLUDED.last_name,
+        is_bot = EXCLUDED.is_bot,
+        is_premium = EXCLUDED.is_premium,
+        is_scam = EXCLUDED.is_scam,
+        is_fake = EXCLUDED.is_fake,
+        is_verified = EXCLUDED.is_verified
+    WHERE (users.username, users.first_name, users.last_name, users.is_bot, users.is_premium, users.is_scam, users.is_fake, users.is_verified)
+        IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.is_bot, EXCLUDED.is_premium, EXCLUDED.is_scam, EXCLUDED.is_fake, EXCLUDED.is_verified)
+"""
+
+UPSERT_CHATS_CLAUSE = """
+    ON CONFLICT (chat_id) DO UPDATE SET
+        title = EXCLUDED.title,
+        is_group = EXCLUDED.is_group,
+        is_channel = EXCLUDED.is_channel,
+        is_user = EXCLUDED.is_user
+    WHERE (chats.title, chats.is_group, chats.is_channel, chats.is_user)
+        IS DISTINCT FROM (EXCLUDED.title, EXCLUDED.is_group, EXCLUDED.is_channel, EXCLUDED.is_user)
+"""
+
+# Folds the rows written by a messages insert (exposed as the "inserted" CTE) into chats_sync_state.
+# Only new rows and live rows upgraded to historical are returned by the insert, so each message is
+# counted exactly once.
+UPDATE_CHATS_SYNC_STATE_QUERY = """
+    , changes AS (
+        SELECT
+            chat_id,
+            MAX(message_id) AS latest_message_id,
+            -- Chats being backfilled in segments have their watermark moved by batch_insert_historical_segments instead
+            CASE
+                WHEN EXISTS (SELECT 1 FROM historical_segments s WHERE s.chat_id = inserted.chat_id) THEN NULL
+                ELSE MAX(message_id) FILTER (WHERE is_historical)
+            END AS historical_message_id,
+            COUNT(*) FILTER (WHERE is_historical) AS historical_message_count
+        FROM inserted
+        GROUP BY chat_id
+    )
+    INSERT INTO chats_sync_state (chat_id, latest_message_id, historical_message_id, historical_message_date, historical_message_count)
+    SELECT c.chat_id, c.latest_message_id, c.historical_message_id, i.date, c.historical_message_count
+    FROM changes c
+    LEFT JOIN inserted i ON i.chat_id = c.chat_id AND i.message_id = c.historical_message_id
+    ON CONFLICT (chat_id) DO UPDATE SET
+        latest_message_id = GREATEST(chats_sync_state.latest_message_id, EXCLUDED.latest_message_id),
+        historical_message_id = GREATEST(chats_sync_state.historical_message_id, EXCLUDED.historical_message_id),
+        historical_message_date = CASE
+            WHEN chats_sync_state.historical_message_id IS NULL OR EXCLUDED.historical_message_id > chats_sync_state.historical_message_id
+            THEN EXCLUDED.historical_message_date
+            ELSE chats_sync_state.historical_message_date
+        END,
+        historical_message_count = chats_sync_state.historical_message_count + EXCLUDED.historical_message_count
+"""
+
+# Rows are NamedTuples whose field order matches the column lists above, so batches go to
+# executemany/copy_records_to_table as they are
+
+class MessageRow(NamedTuple):
     message_id: int
     sender_id: int
     chat_id: int
@@ -178,19 +1014,14 @@ class MessageRow:
 
     @classmethod
     async def from_patched_message(cls, message: patched.Message, is_historical=False):
-        sender = await message.get_sender()
-        if sender:
-            return cls(
-                chat_id=message.chat_id,
-                message_id=message.id,
-                sender_id=sender.id,
-                text=message.text,
-                date=message.date.replace(tzinfo=None),
-                is_historical=is_historical,
-            )
+        _, message_row = await rows_from_message(message, is_historical)
+        return message_row
 
-@dataclass
-class UserRow:
+    @classmethod
+    def from_message(cls, message: patched.Message, sender, is_historical=False):
+        return cls(message.id, sender.id, message.chat_id, message.text, message.date.replace(tzinfo=None), is_historical)
+
+class UserRow(NamedTuple):
     user_id: int
     username: str
     first_name: str
@@ -207,33 +1038,23 @@ class UserRow:
 
     @classmethod
     async def from_patched_message(cls, message: patched.Message):
-        sender = await message.get_sender()
-        if isinstance(sender, types.User):
-            return cls(
-                user_id=sender.id,
-                username=get_username(sender),
-                first_name=sender.first_name,
-                last_name=sender.last_name,
-                is_bot=sender.bot,
-                is_premium=sender.premium,
-                is_scam=sender.scam,
-                is_fake=sender.fake,
-                is_verified=sender.verified,
-            )
-        else: # sender is Channel
-            pass
+        user_row, _ = await rows_from_message(message)
+        return user_row
+
+    @classmethod
+    def from_user(cls, user: types.User):
+        return cls(user.id, get_username(user), user.first_name, user.last_name, user.bot, user.premium, user.scam, user.fake, user.verified)
 
-@dataclass
-class ChatRow:
+class ChatRow(NamedTuple):
     chat_id: int
-    title: int
+    title: str
     is_group: bool
     is_channel: bool
     is_user: bool
 
     @classmethod
-    async def from_new_message_event(cls, event: events.NewMessage.Event):
-        chat = await event.get_chat()
+    async def from_new_message_event(cls, event: events.NewMessage.Event, chat=None):
+        chat = chat or await event.get_chat()
         is_user = isinstance(chat, types.User)
         title = chat.title if not is_user else get_username(chat)
         return cls(
@@ -255,8 +1076,7 @@ class ChatRow:
             is_user=dialog.is_user
         )
 
-@dataclass
-class ChatParticipantsCountRow:
+class ChatParticipantsCountRow(NamedTuple):
     chat_id: int
     participants_count: int
 
@@ -267,3 +1087,43 @@ class ChatParticipantsCountRow:
                 chat_id=dialog.id,
                 participants_count=dialog.entity.participants_count,
             )
+
+class HistoricalSegmentRow(NamedTuple):
+    # Backfill progress of the message id range (start_id, end_id] of a chat split for parallel fetching
+    chat_id: int
+    start_id: int
+    end_id: int
+    progress_id: int
+
+async def rows_from_message(message: patched.Message, is_historical=False, sender=None):
+    # Resolves the sender once, unless the caller already did, and builds both rows from it. The user
+    # row is None when the sender is a channel, and both are None when there is no sender.
+    sender = sender or await message.get_sender()
+    if not sender:
+        return None, None
+    user_row = UserRow.from_user(sender) if isinstance(sender, types.User) else None
+    return user_row, MessageRow.from_message(message, sender, is_historical)
+
+ENTITY_ID_FIELDS = {
+    UserRow: 'user_id',
+    ChatRow: 'chat_id',
+}
+
+# Chats are written before the messages and participant counts that reference them, and segment
+# progress after the messages it covers. Tables within a stage are flushed concurrently.
+FLUSH_STAGES = [
+    [UserRow, ChatRow],
+    [MessageRow, ChatParticipantsCountRow],
+    [HistoricalSegmentRow],
+]
+FLUSH_ORDER = [row_type for stage in FLUSH_STAGES for row_type in stage]
+
+TABLES = {
+    UserRow: 'users',
+    ChatRow: 'chats',
+    MessageRow: 'messages',
+    ChatParticipantsCountRow: 'chats_participants_count',
+    HistoricalSegmentRow: 'historical_segments',
+}
+
+ROW_TYPES = {row_type.__name__: row_type for row_type in FLUSH_ORDER}
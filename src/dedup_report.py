@@ -0,0 +1,66 @@
+import os
+import asyncio
+import argparse
+
+import asyncpg
+from rich.console import Console
+from rich.table import Table
+
+# Text size counts bytes before compression; compressed size is what message_texts actually keeps.
+# Bytes saved compares the inline size of every deduplicated message with the stored bodies plus the
+# 32 byte hash each message keeps instead of its text.
+DEDUP_REPORT_QUERY = """
+    WITH refs AS (
+        SELECT text_hash, count(*) AS messages
+        FROM messages
+        WHERE text_hash IS NOT NULL
+        GROUP BY text_hash
+    )
+    SELECT
+        coalesce(sum(refs.messages), 0)::bigint AS messages,
+        count(*) AS bodies,
+        coalesce(sum(refs.messages * octet_length(t.text)), 0)::bigint AS logical_bytes,
+        coalesce(sum(octet_length(t.text)), 0)::bigint AS stored_bytes,
+        coalesce(sum(pg_column_size(t.text)), 0)::bigint AS compressed_bytes,
+        pg_total_relation_size('message_texts') AS relation_bytes
+    FROM refs
+    JOIN message_texts t ON t.text_hash = refs.text_hash
+"""
+
+async def get_report(dsn):
+    conn = await asyncpg.connect(dsn)
+    try:
+        return await conn.fetchrow(DEDUP_REPORT_QUERY)
+    finally:
+        await conn.close()
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f'{size:.1f} {unit}' if unit != 'B' else f'{size} B'
+        size /= 1024
+    return f'{size:.1f} TiB'
+
+def print_report(report):
+    saved_bytes = report['logical_bytes'] - report['compressed_bytes'] - 32 * report['messages']
+    table = Table(title='Message text deduplication')
+    table.add_column('Metric')
+    table.add_column('Value', justify='right')
+    table.add_row('Deduplicated messages', str(report['messages']))
+    table.add_row('Distinct bodies', str(report['bodies']))
+    table.add_row('Dedup ratio', f"{report['messages'] / report['bodies']:.2f}x" if report['bodies'] else '-')
+    table.add_row('Text size', format_bytes(report['logical_bytes']))
+    table.add_row('Text size after dedup', format_bytes(report['stored_bytes']))
+    table.add_row('Compressed size', format_bytes(report['compressed_bytes']))
+    table.add_row('message_texts on disk', format_bytes(report['relation_bytes']))
+    table.add_row('Bytes saved', format_bytes(saved_bytes))
+    Console().print(table)
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the space saved by TEXT_STORAGE=dedup')
+    parser.add_argument('--dsn', default=os.environ.get('DSN'))
+    args = parser.parse_args()
+    print_report(asyncio.run(get_report(args.dsn)))
+
+if __name__ == '__main__':
+    main()
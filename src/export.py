@@ -0,0 +1,136 @@
+import os
+import json
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timedelta
+
+import asyncpg
+from rich import print
+
+EXPORT_COLUMNS = ['chat_id', 'message_id', 'sender_id', 'text', 'username', 'chat_title', 'date', 'insertion_time']
+
+class Exporter:
+    # Streams messages_with_details to JSONL or Parquet through a server-side cursor, one chunk at a time.
+    # Incremental exports only move rows inserted since the high-water mark stored in the state file.
+    # The mark stays safety_lag behind now(), because insertion_time is taken when a batch's transaction
+    # starts and a row can become visible after rows with later timestamps.
+
+    def __init__(self, dsn, output, format='jsonl', state_path=None):
+        self.dsn = dsn
+        self.output = output
+        self.format = format
+        self.state_path = state_path
+        self.chunk_size = 10000
+        self.safety_lag = timedelta(minutes=1)
+        self.logger = logging.getLogger('export')
+
+    def load_high_water_mark(self):
+        if self.state_path and os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return datetime.fromisoformat(json.load(f)['insertion_time'])
+
+    def save_high_water_mark(self, insertion_time):
+        temporary_path = f'{self.state_path}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({'insertion_time': insertion_time.isoformat()}, f)
+        os.replace(temporary_path, self.state_path)
+
+    async def run(self):
+        since = self.load_high_water_mark()
+        conn = await asyncpg.connect(self.dsn)
+        try:
+            until = await conn.fetchval('SELECT LOCALTIMESTAMP - $1::interval', self.safety_lag)
+            writer = ParquetWriter if self.format == 'parquet' else JsonlWriter
+            temporary_output = f'{self.output}.tmp'
+            rows = 0
+            with writer(temporary_output) as write_chunk:
+                # Cursors only exist inside a transaction; a repeatable read snapshot keeps the export consistent
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    cursor = await conn.cursor(f"""
+                        SELECT {', '.join(EXPORT_COLUMNS)}
+                        FROM messages_with_details
+                        WHERE ($1::timestamp IS NULL OR insertion_time > $1) AND insertion_time <= $2
+                    """, since, until)
+                    while chunk := await cursor.fetch(self.chunk_size):
+                        write_chunk(chunk)
+                        rows += len(chunk)
+            os.replace(temporary_output, self.output)
+        finally:
+            await conn.close()
+        if self.state_path:
+            self.save_high_water_mark(until)
+        print(f'[bold green]Exported {rows} messages inserted {f"after {since} " if since else ""}up to {until} to {self.output}[/bold green]')
+        return rows
+
+class JsonlWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'w')
+        return self.write_chunk
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def write_chunk(self, rows):
+        self.file.writelines(json.dumps({column: to_json_value(row[column]) for column in EXPORT_COLUMNS}) + '\n' for row in rows)
+
+class ParquetWriter:
+    # Each chunk becomes one row group, so memory stays bounded by the chunk size
+
+    def __init__(self, path):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Parquet export requires pyarrow (pip install pyarrow)')
+        self.pyarrow = pyarrow
+        self.path = path
+        self.schema = pyarrow.schema([
+            ('chat_id', pyarrow.int64()),
+            ('message_id', pyarrow.int64()),
+            ('sender_id', pyarrow.int64()),
+            ('text', pyarrow.string()),
+            ('username', pyarrow.string()),
+            ('chat_title', pyarrow.string()),
+            ('date', pyarrow.timestamp('us')),
+            ('insertion_time', pyarrow.timestamp('us')),
+        ])
+        self.writer = None
+
+    def __enter__(self):
+        self.writer = self.pyarrow.parquet.ParquetWriter(self.path, self.schema, compression='zstd')
+        return self.write_chunk
+
+    def __exit__(self, *exc_info):
+        self.writer.close()
+
+    def write_chunk(self, rows):
+        columns = {column: [row[column] for row in rows] for column in EXPORT_COLUMNS}
+        self.writer.write_table(self.pyarrow.table(columns, schema=self.schema))
+
+def to_json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export messages_with_details to JSONL or Parquet')
+    parser.add_argument('output', help='File to write; it only appears once the export is complete')
+    parser.add_argument('--dsn', default=os.environ.get('DSN'))
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], help='Defaults to the output file extension')
+    parser.add_argument('--state', help='High-water mark file; when given, only rows inserted since the previous export are written')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    format = args.format or ('parquet' if args.output.endswith('.parquet') else 'jsonl')
+    exporter = Exporter(args.dsn, args.output, format, args.state)
+    exporter.chunk_size = args.chunk_size
+    asyncio.run(exporter.run())
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,30 @@
 import os
+import signal
 import asyncio
 import logging
 
+from rich import print
 from rich.logging import RichHandler
 
 from .database import DatabaseManager
 from .websocket import WebSocketManager
 from .telegram import TelegramManager
+from .metrics import MetricsServer, BACKFILL_CHATS_REMAINING
+from .spool import Spool
 
 API_ID = os.environ['API_ID']
 API_HASH = os.environ['API_HASH']
 DSN = os.environ['DSN']
+INSERT_MODE = os.environ.get('INSERT_MODE', 'executemany')
+TEXT_STORAGE = os.environ.get('TEXT_STORAGE', 'inline')
+RETENTION_MONTHS = os.environ.get('RETENTION_MONTHS')
+RETENTION_POLICY = os.environ.get('RETENTION_POLICY', 'detach')
 DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 5123
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9123))
+SPOOL_DIR = os.environ.get('SPOOL_DIR', 'spool')
+SESSIONS = os.environ.get('SESSIONS', 'user').split(',')
+STATE_DIR = os.environ.get('STATE_DIR', 'state')
 
 logging.basicConfig(
     level=logging.WARN,
@@ -25,10 +37,62 @@ logging.basicConfig(
 
 async def main():
     database_manager = DatabaseManager(DSN)
-    websocket_manager = WebSocketManager(DEFAULT_HOST, DEFAULT_PORT)
-    telegram_manager = TelegramManager(API_ID, API_HASH, database_manager, websocket_manager)
+    database_manager.insert_mode = INSERT_MODE
+    database_manager.text_storage = TEXT_STORAGE
+    database_manager.spool = Spool(SPOOL_DIR)
+    if RETENTION_MONTHS:
+        database_manager.retention_months = int(RETENTION_MONTHS)
+        database_manager.retention_policy = RETENTION_POLICY
+    websocket_manager = WebSocketManager(DEFAULT_HOST, DEFAULT_PORT, database_manager)
+    telegram_managers = [
+        TelegramManager(API_ID, API_HASH, database_manager, websocket_manager, session=session.strip())
+        for session in SESSIONS
+    ]
+    for telegram_manager in telegram_managers:
+        telegram_manager.snapshot_path = os.path.join(STATE_DIR, f'{telegram_manager.session}.snapshot')
+    # Registered here rather than by each manager, so the gauge covers every session
+    BACKFILL_CHATS_REMAINING.set_function(lambda: {
+        (manager.session,): len(manager.historical_messages_scheduled_chat_set) for manager in telegram_managers
+    })
+    metrics_server = MetricsServer(DEFAULT_HOST, METRICS_PORT)
 
-    await telegram_manager.run()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, request_stop, loop, stop_event)
+
+    database_task = asyncio.create_task(database_manager.run())
+    websocket_task = asyncio.create_task(websocket_manager.run())
+    telegram_tasks = [asyncio.create_task(telegram_manager.run()) for telegram_manager in telegram_managers]
+    metrics_task = asyncio.create_task(metrics_server.run())
+    stop_task = asyncio.create_task(stop_event.wait())
+    done, _ = await asyncio.wait([stop_task, database_task, websocket_task, *telegram_tasks, metrics_task], return_when=asyncio.FIRST_COMPLETED)
+
+    # Stopped in dependency order: the Telegram managers save their snapshots (which waits for their rows
+    # to be flushed) and disconnect, then the database writer flushes what is left and the servers close
+    print('[bold yellow]Shutting down[/bold yellow]')
+    for telegram_manager, telegram_task in zip(telegram_managers, telegram_tasks):
+        await telegram_manager.stop()
+        telegram_task.cancel()
+    await asyncio.gather(*telegram_tasks, return_exceptions=True)
+    database_manager.stop()
+    await asyncio.gather(database_task, return_exceptions=True)
+    await websocket_manager.stop()
+    await metrics_server.stop()
+    for task in (websocket_task, metrics_task, stop_task):
+        task.cancel()
+    await asyncio.gather(websocket_task, metrics_task, stop_task, return_exceptions=True)
+
+    # Surface the error of a task that stopped on its own
+    for task in done - {stop_task}:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+def request_stop(loop, stop_event):
+    # A second signal exits right away
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.remove_signal_handler(signal_number)
+    stop_event.set()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import math
+from bisect import bisect_left
+
+from rich import print
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.function = None
+        REGISTRY.register(self)
+
+    def set_function(self, function):
+        # The function is called at scrape time and returns {label values tuple: value}, or a plain
+        # number for unlabelled metrics
+        self.function = function
+
+    def current_values(self):
+        if self.function is None:
+            return self.values
+        values = self.function()
+        return values if isinstance(values, dict) else {(): values}
+
+    def label_key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = [*zip(self.labelnames, key), *extra]
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        for key, value in self.current_values().items():
+            yield self.name, self.format_labels(tuple(map(str, key))), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self.label_key(labels)] = value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = self.label_key(labels)
+        if (series := self.series.get(key)) is None:
+            series = self.series[key] = HistogramSeries(len(self.buckets))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    def samples(self):
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), series.counts):
+                cumulative += count
+                yield f'{self.name}_bucket', self.format_labels(key, [('le', format_value(bound))]), cumulative
+            yield f'{self.name}_sum', self.format_labels(key), series.sum
+            yield f'{self.name}_count', self.format_labels(key), cumulative
+
+class HistogramSeries:
+
+    def __init__(self, buckets):
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        self.metrics[metric.name] = metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+REGISTRY = Registry()
+
+class MetricsServer:
+    # Minimal HTTP server exposing the registry in the Prometheus text format on /metrics
+
+    def __init__(self, host, port, registry=REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.server = None
+        self.logger = logging.getLogger('metrics')
+
+    async def run(self):
+        self.server = await asyncio.start_server(self.handler, self.host, self.port)
+        print(f'[bold green]Serving metrics at http://{self.host}:{self.port}/metrics[/bold green]')
+        await self.server.serve_forever()
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def handler(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while await reader.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            method, path, *_ = request_line.decode('latin-1').split()
+            if method == 'GET' and path.split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not Found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (ValueError, ConnectionError) as e:
+            self.logger.warning(f'Invalid metrics request: {e!r}')
+        finally:
+            writer.close()
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+INSERT_BUFFER_ROWS = Gauge('indexer_insert_buffer_rows', 'Rows waiting in the insert buffers', ['row_type'])
+BATCH_ROWS = Histogram('indexer_batch_rows', 'Rows per batch insert', ['table'], buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000, 50000))
+FLUSH_DURATION = Histogram('indexer_flush_duration_seconds', 'Duration of batch inserts', ['table'])
+ROWS_DROPPED = Counter('indexer_rows_dropped_total', 'Rows lost to PostgreSQL errors during batch inserts', ['table'])
+ROWS_EXPIRED = Counter('indexer_rows_expired_total', 'Messages skipped because they are older than the retention period')
+SPOOLED_ROWS = Counter('indexer_spooled_rows_total', 'Rows written to the on-disk spool', ['table'])
+SPOOL_SEGMENTS = Gauge('indexer_spool_segments', 'Spool segments waiting to be replayed')
+ENTITY_CACHE_LOOKUPS = Counter('indexer_entity_cache_lookups_total', 'User and chat rows checked against the entity cache', ['result'])
+
+BACKFILL_MESSAGES = Counter('indexer_backfill_messages_total', 'Historical messages fetched', ['chat_id'])
+BACKFILL_CHATS_REMAINING = Gauge('indexer_backfill_chats_remaining', 'Chats scheduled or being processed for backfill', ['session'])
+CHAT_LEASES = Gauge('indexer_chat_leases', 'Chats leased by each ingest session', ['session'])
+DIALOGS_PASS_DURATION = Histogram('indexer_dialogs_pass_duration_seconds', 'Duration of a full pass over the dialogs', buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+DIALOGS_CHANGED = Counter('indexer_dialogs_changed_total', 'Dialogs found changed since the previous dialogs pass')
+LIVE_RECEIVE_TO_BROADCAST = Histogram('indexer_live_receive_to_broadcast_seconds', 'Time from receiving a new message to handing it to the websocket clients')
+LIVE_RECEIVE_TO_COMMIT = Histogram('indexer_live_receive_to_commit_seconds', 'Time from receiving a new message to its flush being written to the database', buckets=(0.05, 0.1, 0.25, 0.5, 1, 1.5, 2, 3, 5, 10, 30))
+FLOOD_WAIT_SECONDS = Counter('indexer_flood_wait_seconds_total', 'Seconds spent waiting on Telegram FloodWait errors', ['source'])
+TELEGRAM_REQUEST_RATE = Gauge('indexer_telegram_request_rate', 'Requests per second currently allowed by the rate controller', ['session'])
+
+WEBSOCKET_CLIENTS = Gauge('indexer_websocket_clients', 'Connected websocket clients')
+WEBSOCKET_SEND_LAG = Histogram('indexer_websocket_send_lag_seconds', 'Time messages spend in a client queue before being sent')
+WEBSOCKET_MESSAGES_DROPPED = Counter('indexer_websocket_messages_dropped_total', 'Messages dropped because a client queue was full')
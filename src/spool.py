@@ -0,0 +1,88 @@
+import os
+import pickle
+import struct
+import asyncio
+import logging
+
+RECORD_HEADER = struct.Struct('>I')
+
+class Spool:
+    # Append-only on-disk queue of row batches. Each batch is one length-prefixed pickled record in the
+    # current segment file; segments are replayed oldest first and deleted once fully written.
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(name for name in os.listdir(directory) if name.endswith('.spool'))
+        self.next_segment_number = int(self.segments[-1].split('.')[0]) + 1 if self.segments else 0
+        self.current_segment = None
+        self.current_segment_file = None
+        self.replayed_records = {}
+        self._lock = asyncio.Lock()
+        self.logger = logging.getLogger('spool')
+        if self.segments:
+            self.logger.warning(f'Found {len(self.segments)} spool segments to replay in {directory}')
+
+    def has_pending(self):
+        return bool(self.segments)
+
+    def size(self):
+        return sum(os.path.getsize(self.path(segment)) for segment in self.segments)
+
+    def path(self, segment):
+        return os.path.join(self.directory, segment)
+
+    async def append(self, kind, records):
+        data = pickle.dumps((kind, records), protocol=pickle.HIGHEST_PROTOCOL)
+        async with self._lock:
+            await asyncio.to_thread(self._write, RECORD_HEADER.pack(len(data)) + data)
+
+    def _write(self, record):
+        if self.current_segment_file is None:
+            self.current_segment = f'{self.next_segment_number:016d}.spool'
+            self.next_segment_number += 1
+            self.current_segment_file = open(self.path(self.current_segment), 'ab')
+            self.segments.append(self.current_segment)
+        self.current_segment_file.write(record)
+        self.current_segment_file.flush()
+        os.fsync(self.current_segment_file.fileno())
+        if self.current_segment_file.tell() >= self.segment_size:
+            self._seal()
+
+    def _seal(self):
+        if self.current_segment_file is not None:
+            self.current_segment_file.close()
+            self.current_segment_file = None
+            self.current_segment = None
+
+    async def replay(self, handler):
+        # Feeds every spooled batch to `handler(kind, records)` in order. If the handler raises, replay
+        # stops there and resumes from the same batch on the next call.
+        async with self._lock:
+            self._seal()
+            while self.segments:
+                segment = self.segments[0]
+                batches = await asyncio.to_thread(read_segment, self.path(segment))
+                for index in range(self.replayed_records.get(segment, 0), len(batches)):
+                    await handler(*batches[index])
+                    self.replayed_records[segment] = index + 1
+                os.remove(self.path(segment))
+                self.segments.pop(0)
+                self.replayed_records.pop(segment, None)
+                self.logger.info(f'Replayed spool segment {segment} ({len(batches)} batches)')
+
+def read_segment(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    batches = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        (length,) = RECORD_HEADER.unpack_from(data, offset)
+        offset += RECORD_HEADER.size
+        if offset + length > len(data):
+            # Torn write from a crash, everything before it is intact
+            break
+        batches.append(pickle.loads(data[offset:offset + length]))
+        offset += length
+    return batches
@@ -1,10 +1,14 @@
+import os
+import pickle
 import asyncio
 import logging
 import json
+import math
+import time
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, errors
 
 from rich.progress import Progress, TextColumn
 from rich.console import Console
@@ -14,39 +18,76 @@ from rich.console import Group
 from rich.live import Live
 from rich import print
 
-from .database import DatabaseManager, UserRow, ChatRow, MessageRow, ChatParticipantsCountRow
+from .database import TRANSIENT_ERRORS, DatabaseManager, ChatRow, ChatParticipantsCountRow, HistoricalSegmentRow, rows_from_message
 from .websocket import WebSocketManager
-from .utils import get_full_name
+from .utils import get_full_name, RateController, REQUEST_PRIORITY, PRIORITY_NAMES, LIVE_PRIORITY, DIALOGS_PRIORITY, BACKFILL_PRIORITY
+from .cache import LookupCache
 from .rich_utils import MessagesPerSecondColumn
+from .metrics import BACKFILL_MESSAGES, CHAT_LEASES, DIALOGS_PASS_DURATION, DIALOGS_CHANGED, FLOOD_WAIT_SECONDS, LIVE_RECEIVE_TO_BROADCAST, LIVE_RECEIVE_TO_COMMIT, TELEGRAM_REQUEST_RATE
 
 class TelegramManager:
 
-    def __init__(self, api_id, api_hash, database_manager: DatabaseManager, websocket_manager: WebSocketManager):
-        self.client = TelegramClient('user', api_id, api_hash, connection_retries=None, request_retries=None)
+    def __init__(self, api_id, api_hash, database_manager: DatabaseManager, websocket_manager: WebSocketManager, client=None, session='user'):
+        # Several managers, one per account, can share the database and websocket managers. The session
+        # name identifies the account in the chat leases, so it must be unique across processes too.
+        self.session = session
+        # Every request of this account, live, dialogs and backfill alike, goes through one rate controller
+        self.rate_controller = RateController(on_rate_change=lambda rate: TELEGRAM_REQUEST_RATE.set(rate, session=session))
+        TELEGRAM_REQUEST_RATE.set(self.rate_controller.rate, session=session)
+        self.client = client or RateControlledTelegramClient(session, api_id, api_hash, rate_controller=self.rate_controller, connection_retries=None, request_retries=None)
         self.client.add_event_handler(self.new_message_handler, events.NewMessage)
 
         self.database = database_manager
-        self.database_task = None
-
         self.websocket = websocket_manager
-        self.websocket_task = None
 
-        self.historical_messages_chat_queue = asyncio.Queue()
+        self.historical_messages_chat_queue = asyncio.PriorityQueue()
         self.historical_messages_scheduled_chat_set = set()
-        self.historical_messages_loop_wait_time = 1
+        self.historical_messages_workers = 4
+        self.historical_messages_batch_size = 100
+        self.historical_messages_last_pass_time = {}
+        self.historical_messages_priorities = {}
+        self.historical_messages_progress = None
+        self.historical_messages_split_threshold = 100000
+        self.historical_messages_split_segments = 4
 
         self.dialogs_loop_wait_time = 20
+        self.dialogs_loop_min_wait_time = 5
+        self.dialogs_loop_max_wait_time = 300
+        self.dialogs_loop_busy_ratio = 0.05
+        self.dialogs_fingerprints = {}
         self.dialogs_loop_first_pass_event = asyncio.Event()
         self.dialogs_loop_last_pass_time = None
+        self.dialogs_last_message_date = {}
 
         self.scheduler_loop_wait_time = 60
 
+        # One queue per worker and each chat always goes to the same one, so chats are processed in
+        # parallel while the messages of a chat keep their order
+        self.live_messages_queue_size = 1000
+        self.live_messages_workers = 4
+        self.live_messages_queues = [asyncio.Queue(self.live_messages_queue_size) for _ in range(self.live_messages_workers)]
+        self.live_entity_cache = LookupCache(max_size=10000, ttl=300)
+
+        self.chat_leases = set()
+        self.chats_pinned_elsewhere = set()
+        self.chat_leases_released = set()
+        self.chat_lease_duration = timedelta(minutes=5)
+        self.chat_leases_loop_wait_time = 60
+        self.chat_leases_first_pass_event = asyncio.Event()
+
+        # Warm restart: the scheduling and dialogs state is saved here periodically and loaded at startup,
+        # so backfill resumes right away while the first dialogs pass reconciles in the background
+        self.snapshot_path = None
+        self.snapshot_loop_wait_time = 60
+        self.snapshot_flush_timeout = 30
+
         self.stop_event = asyncio.Event()
 
         self.main_logger = logging.getLogger('telegram_main')
         self.scheduler_logger = logging.getLogger('telegram_scheduler')
         self.historical_messages_logger = logging.getLogger('telegram_historical_messages')
         self.dialogs_logger = logging.getLogger('telegram_dialogs')
+        self.chat_leases_logger = logging.getLogger('telegram_chat_leases')
 
         self.historical_messages_current_chat_title = None
         self.historical_messages_current_chat_progress = None
@@ -56,27 +97,31 @@ class TelegramManager:
         # self.group = Group()
 
     async def run(self):
-        self.main_logger.info('Starting TelegramManager')
-        self.websocket_task = asyncio.create_task(self.websocket.run())
-        self.database_task = asyncio.create_task(self.database.run())
-        await self.client.start()
+        # The shared database and websocket managers are run by the caller
+        self.main_logger.info(f'Starting TelegramManager for session {self.session}')
+        await self.restore_snapshot()
+        # Telethon's update loop is started here and inherits the priority. Its GetDifference calls fetch
+        # the live messages missed in gaps, so they go ahead of backfill.
+        token = REQUEST_PRIORITY.set(LIVE_PRIORITY)
+        try:
+            await self.client.start()
+        finally:
+            REQUEST_PRIORITY.reset(token)
         await self.main_loop()
 
     async def stop(self):
-        self.main_logger.info('Stopping TelegramManager')
+        self.main_logger.info(f'Stopping TelegramManager for session {self.session}')
         self.stop_event.set()
-        self.database.stop()
-        self.websocket.stop()
-        await asyncio.gather(
-            self.client.disconnect(),
-            self.database_task,
-            self.websocket_task,
-        )
+        await self.save_snapshot()
+        await self.client.disconnect()
 
     async def main_loop(self):
         historical_messages_task = asyncio.create_task(self.historical_messages_loop())
         dialogs_task = asyncio.create_task(self.dialogs_loop())
         scheduler_task = asyncio.create_task(self.scheduler_loop())
+        chat_leases_task = asyncio.create_task(self.chat_leases_loop())
+        live_messages_task = asyncio.create_task(self.live_messages_loop())
+        snapshot_task = asyncio.create_task(self.snapshot_loop())
 
         # with Live(refresh_per_second=2) as live:
         #     while True:
@@ -84,118 +129,458 @@ class TelegramManager:
         #         live.update(Text(f'Last dialogs pass: {last_pass_timedelta or '-'}'))
         #         await asyncio.sleep(1)
 
-        await asyncio.gather(historical_messages_task, dialogs_task, scheduler_task)
+        await asyncio.gather(historical_messages_task, dialogs_task, scheduler_task, chat_leases_task, live_messages_task, snapshot_task)
 
     async def scheduler_loop(self):
-        self.scheduler_logger.info('Waiting for iter dialogs first pass')
-        await self.dialogs_loop_first_pass_event.wait()
+        self.scheduler_logger.info('Waiting for the first chat leases')
+        await self.chat_leases_first_pass_event.wait()
         await asyncio.sleep(1) # Wait for one extra second before making queries on the database
 
         while True:
             chats_scheduled = 0
             self.scheduler_logger.info('Fetching messages from database for scheduling')
-            rows = await self.database.get_all_latest_message_ids()
-            for row in rows:
+            try:
+                rows = await self.database.get_all_latest_message_ids()
+            except TRANSIENT_ERRORS as e:
+                self.scheduler_logger.error(f'Database unavailable during scheduling: {e!r}')
+                rows = None
+            # Nothing is scheduled this round when the query failed, the next one retries
+            for row in rows or []:
                 if row['latest_historical_message_id'] is None or row['latest_message_id'] > row['latest_historical_message_id']:
-                    if row['chat_id'] not in self.historical_messages_scheduled_chat_set:
-                        chat_title = await self.database.get_chat_title(row['chat_id'])
-                        # self.scheduler_logger.info(f'Inserting chat \'{chat_title}\' into processing queue')
-                        self.historical_messages_scheduled_chat_set.add(row['chat_id'])
-                        await self.historical_messages_chat_queue.put(row['chat_id'])
+                    # Chats leased by other sessions are theirs to backfill
+                    if row['chat_id'] in self.chat_leases and row['chat_id'] not in self.historical_messages_scheduled_chat_set:
+                        remaining_messages = row['latest_message_id'] - (row['latest_historical_message_id'] or 0)
+                        priority = self.get_historical_messages_priority(row['chat_id'], remaining_messages)
+                        await self.schedule_historical_messages(row['chat_id'], priority)
                         chats_scheduled += 1
             self.scheduler_logger.info(f'Scheduled {chats_scheduled} chats')
             self.scheduler_logger.info(f'Current queue size: {len(self.historical_messages_scheduled_chat_set)}')
             await asyncio.sleep(self.scheduler_loop_wait_time)
 
+    async def schedule_historical_messages(self, chat_id, priority):
+        self.historical_messages_scheduled_chat_set.add(chat_id)
+        self.historical_messages_priorities[chat_id] = priority
+        await self.historical_messages_chat_queue.put((priority, chat_id))
+
+    async def snapshot_loop(self):
+        while not self.stop_event.is_set():
+            await asyncio.sleep(self.snapshot_loop_wait_time)
+            await self.save_snapshot()
+
+    def get_snapshot(self):
+        return {
+            'version': SNAPSHOT_VERSION,
+            'session': self.session,
+            'time': datetime.now(),
+            'dialogs_fingerprints': dict(self.dialogs_fingerprints),
+            'dialogs_last_message_date': dict(self.dialogs_last_message_date),
+            'historical_messages_last_pass_time': dict(self.historical_messages_last_pass_time),
+            'historical_messages_scheduled': {
+                chat_id: self.historical_messages_priorities.get(chat_id, 0) for chat_id in self.historical_messages_scheduled_chat_set
+            },
+            'chat_leases': set(self.chat_leases),
+        }
+
+    async def save_snapshot(self):
+        if self.snapshot_path is None:
+            return
+        snapshot = self.get_snapshot()
+        # The dialogs fingerprints stand for rows already queued; the snapshot is only written once those
+        # rows are in the database, otherwise a crash could leave chats that are never queued again
+        try:
+            await asyncio.wait_for(self.database.wait_for_flush(), self.snapshot_flush_timeout)
+        except asyncio.TimeoutError:
+            self.main_logger.warning('Skipping snapshot, the database writer did not flush in time')
+            return
+        await asyncio.to_thread(write_snapshot, self.snapshot_path, snapshot)
+
+    async def restore_snapshot(self):
+        if self.snapshot_path is None or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            snapshot = await asyncio.to_thread(read_snapshot, self.snapshot_path)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            self.main_logger.warning(f'Ignoring unreadable snapshot {self.snapshot_path}: {e!r}')
+            return
+        if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('session') != self.session:
+            self.main_logger.warning(f'Ignoring snapshot {self.snapshot_path} from another version or session')
+            return
+        self.dialogs_fingerprints = snapshot['dialogs_fingerprints']
+        self.dialogs_last_message_date = snapshot['dialogs_last_message_date']
+        self.historical_messages_last_pass_time = snapshot['historical_messages_last_pass_time']
+        self.chat_leases = snapshot['chat_leases']
+        for chat_id, priority in snapshot['historical_messages_scheduled'].items():
+            await self.schedule_historical_messages(chat_id, priority)
+        # The restored dialogs stand in for the first pass, so leases and the scheduler don't wait for it
+        self.dialogs_loop_first_pass_event.set()
+        self.main_logger.info(
+            f'Restored snapshot from {snapshot['time']}: {len(self.dialogs_fingerprints)} dialogs, '
+            f'{len(self.historical_messages_scheduled_chat_set)} chats scheduled for backfill'
+        )
+
+    def get_chat_title(self, chat_id):
+        if fingerprint := self.dialogs_fingerprints.get(chat_id):
+            return fingerprint[0].title
+
     async def dialogs_loop(self):
+        REQUEST_PRIORITY.set(DIALOGS_PRIORITY)
         while not self.stop_event.is_set():
             self.dialogs_logger.info('Looping through dialogs')
+            pass_start_time = time.perf_counter()
+            dialogs = 0
+            dialogs_changed = 0
             async for dialog in self.client.iter_dialogs():
-                if chat := await ChatRow.from_dialog(dialog):
-                    await self.database.queue_insert(chat)
-                if user := await UserRow.from_patched_message(dialog.message):
-                    await self.database.queue_insert(user)
-                if message := await MessageRow.from_patched_message(dialog.message):
-                    await self.database.queue_insert(message)
-                if chat_participants_count := await ChatParticipantsCountRow.from_dialog(dialog):
-                    await self.database.queue_insert(chat_participants_count)
-            self.dialogs_logger.info('Finished looping through dialogs')
+                self.dialogs_last_message_date[dialog.id] = dialog.date
+                dialogs += 1
+                if await self.queue_dialog_changes(dialog):
+                    dialogs_changed += 1
+            self.dialogs_logger.info(f'Finished looping through dialogs, {dialogs_changed} of {dialogs} changed')
+            DIALOGS_PASS_DURATION.observe(time.perf_counter() - pass_start_time)
             if not self.dialogs_loop_first_pass_event.is_set():
                 self.dialogs_logger.info('Signaling first pass')
                 self.dialogs_loop_first_pass_event.set()
             self.dialogs_loop_last_pass_time = datetime.now()
-            print(f'Finished dialogs pass at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+            self.dialogs_loop_wait_time = self.get_dialogs_loop_wait_time(dialogs_changed, dialogs)
+            print(f'Finished dialogs pass at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, next in {self.dialogs_loop_wait_time:.0f}s')
             await asyncio.sleep(self.dialogs_loop_wait_time)
 
+    async def queue_dialog_changes(self, dialog):
+        # Only the parts of the dialog that changed since the previous pass are queued: the chat when its
+        # title or type changed, the top message when it's a new one and the participant count when it moved
+        chat = await ChatRow.from_dialog(dialog)
+        top_message_id = dialog.message.id if dialog.message else None
+        previous = self.dialogs_fingerprints.get(dialog.id, (None, None, None))
+        chat_participants_count = await ChatParticipantsCountRow.from_dialog(dialog)
+        if dialog.id not in self.chat_leases:
+            # Participant counts are stored by the session leasing the chat; keep the last stored one so
+            # the count is written as soon as this session gets the lease
+            chat_participants_count = previous[2]
+        if not self.owns_messages(dialog.id, dialog.is_channel):
+            # Same for the top message, so it's queued, and the chat gets scheduled for backfill, once the
+            # lease is gained
+            top_message_id = previous[1]
+        fingerprint = (chat, top_message_id, chat_participants_count)
+        if fingerprint == previous:
+            return False
+        self.dialogs_fingerprints[dialog.id] = fingerprint
+
+        if chat and chat != previous[0]:
+            await self.database.queue_insert(chat)
+        if top_message_id != previous[1]:
+            user, message = await rows_from_message(dialog.message)
+            if user:
+                await self.database.queue_insert(user)
+            if message:
+                await self.database.queue_insert(message)
+        if chat_participants_count and chat_participants_count != previous[2]:
+            await self.database.queue_insert(chat_participants_count)
+        DIALOGS_CHANGED.inc()
+        return True
+
+    def get_dialogs_loop_wait_time(self, dialogs_changed, dialogs):
+        # Passes where a good share of the dialogs changed come back twice as fast, quiet ones back off
+        # gradually; new messages keep arriving through the NewMessage handler in the meantime
+        if dialogs and dialogs_changed / dialogs >= self.dialogs_loop_busy_ratio:
+            wait_time = self.dialogs_loop_wait_time / 2
+        else:
+            wait_time = self.dialogs_loop_wait_time * 1.5
+        return min(max(wait_time, self.dialogs_loop_min_wait_time), self.dialogs_loop_max_wait_time)
+
+    async def chat_leases_loop(self):
+        await self.dialogs_loop_first_pass_event.wait()
+        while not self.stop_event.is_set():
+            try:
+                await self.update_chat_leases()
+            except TRANSIENT_ERRORS as e:
+                self.chat_leases_logger.error(f'Database unavailable during chat leases update: {e!r}')
+            self.chat_leases_first_pass_event.set()
+            await asyncio.sleep(self.chat_leases_loop_wait_time)
+
+    async def update_chat_leases(self):
+        # Channels and supergroups have global message ids, so their leases move freely. Each one counts
+        # for 1/n of a share for each of the n live sessions that can see it, and a session holding more
+        # than its share only releases chats another live session can see. Every visible chat without a
+        # live holder is claimed, whatever the share, so none is left unleased.
+        # Private chats and basic groups have per-account ids and may still be shared (a group, or a peer
+        # like 777000 that several accounts talk to), so they stay pinned to the first session that claims
+        # them and the others leave them alone.
+        account_chats = {chat_id for chat_id, (chat, _, _) in self.dialogs_fingerprints.items() if not chat.is_channel}
+        shared_chats = self.dialogs_fingerprints.keys() - account_chats
+        # If the renewal fails, the current leases are kept until the next attempt rather than dropping
+        # every message of the leased chats in the meantime
+        if (renewal := await self.database.renew_chat_leases(self.session, self.chat_lease_duration, shared_chats)) is None:
+            return
+        self.chat_leases, viewers = renewal
+        leased_shared_chats = self.chat_leases & shared_chats
+        fair_share = math.ceil(sum(1 / viewers.get(chat_id, 1) for chat_id in shared_chats))
+
+        released = set()
+        if len(leased_shared_chats) > fair_share:
+            # Chats waiting for or being backfilled are the last ones given away
+            releasable = sorted(
+                (chat_id for chat_id in leased_shared_chats if viewers.get(chat_id, 1) > 1),
+                key=lambda chat_id: chat_id in self.historical_messages_scheduled_chat_set,
+            )
+            if released := set(releasable[:len(leased_shared_chats) - fair_share]):
+                await self.database.release_chat_leases(self.session, released)
+                self.chat_leases -= released
+                self.chat_leases_logger.info(f'Released {len(released)} chats to other sessions')
+        # Chats released in the previous round are left for the other sessions to claim
+        if unleased_shared_chats := shared_chats - self.chat_leases - self.chat_leases_released:
+            self.chat_leases |= await self.database.claim_chat_leases(self.session, unleased_shared_chats, self.chat_lease_duration)
+        self.chat_leases_released = released
+        if unleased_account_chats := account_chats - self.chat_leases - self.chats_pinned_elsewhere:
+            claimed = await self.database.claim_pinned_chat_leases(self.session, unleased_account_chats)
+            self.chat_leases |= claimed
+            if pinned_elsewhere := unleased_account_chats - claimed:
+                self.chats_pinned_elsewhere |= pinned_elsewhere
+                self.chat_leases_logger.warning(f'{len(pinned_elsewhere)} private chats or basic groups are indexed by another session: {sorted(pinned_elsewhere)}')
+        CHAT_LEASES.set(len(self.chat_leases), session=self.session)
+
+    def owns_messages(self, chat_id, is_channel):
+        # Channel and supergroup message ids are global, so every session can store them and the upsert
+        # keeps a single row. Elsewhere ids are per account and only the session leasing the chat stores them.
+        return is_channel or chat_id in self.chat_leases
+
+    def get_historical_messages_priority(self, chat_id, remaining_messages):
+        # Lower values are processed first: small backlogs and recently active chats go ahead of large
+        # quiet channels, and chats that haven't been backfilled in a while slowly move up the queue
+        priority = math.log10(max(remaining_messages, 0) + 1)
+        if last_message_date := self.dialogs_last_message_date.get(chat_id):
+            idle_hours = (datetime.now(timezone.utc) - last_message_date).total_seconds() / 3600
+            priority += math.log10(max(idle_hours, 0) + 1)
+        if last_pass_time := self.historical_messages_last_pass_time.get(chat_id):
+            waiting_hours = (datetime.now() - last_pass_time).total_seconds() / 3600
+            priority -= math.log10(waiting_hours + 1)
+        return priority
+
     async def historical_messages_loop(self):
+        columns = (*Progress.get_default_columns(), MessagesPerSecondColumn(), TextColumn('(Remaining chats: {task.fields[chats_remaining]})'))
+        with Progress(*columns) as progress:
+            self.historical_messages_progress = progress
+            workers = [asyncio.create_task(self.historical_messages_worker()) for _ in range(self.historical_messages_workers)]
+            await asyncio.gather(*workers)
+
+    async def historical_messages_worker(self):
+        REQUEST_PRIORITY.set(BACKFILL_PRIORITY)
         while True:
-            chat_id = await self.historical_messages_chat_queue.get()
-            chat_title = await self.database.get_chat_title(chat_id)
-            self.historical_messages_logger.info(f'Popped chat {chat_title} from processing queue')
-
-            self.historical_messages_scheduled_chat_set.remove(chat_id)
-            if row := await self.database.get_latest_historical_message(chat_id):
-                min_id = row['message_id']
-                self.historical_messages_logger.info(f'Processing historical information for chat \'{chat_title}\' from {row['date']}')
+            _, chat_id = await self.historical_messages_chat_queue.get()
+            try:
+                await self.process_historical_messages(chat_id)
+            except Exception:
+                self.historical_messages_logger.exception(f'Failed processing historical messages for chat {chat_id}')
+            finally:
+                # The chat stays in the scheduled set until it's done so the scheduler never hands it to a second worker
+                self.historical_messages_scheduled_chat_set.discard(chat_id)
+                self.historical_messages_priorities.pop(chat_id, None)
+                self.historical_messages_last_pass_time[chat_id] = datetime.now()
+
+    async def process_historical_messages(self, chat_id):
+        chat_title = self.get_chat_title(chat_id) or await self.database.get_chat_title(chat_id)
+        self.historical_messages_logger.info(f'Popped chat {chat_title} from processing queue')
+
+        if row := await self.database.get_latest_historical_message(chat_id):
+            min_id = row['message_id']
+            self.historical_messages_logger.info(f'Processing historical information for chat \'{chat_title}\' from {row['date']}')
+        else:
+            min_id = 0
+            self.historical_messages_logger.info(f'Processing historical information for chat \'{chat_title}\' from inception')
+
+        segments = await self.database.get_historical_segments(chat_id)
+        total_messages, top_message_id = await self.get_total_number_of_messages(chat_id)
+        remaining_messages = total_messages - await self.database.get_historical_message_count(chat_id)
+
+        if remaining_messages <= 0 and not segments:
+            return
+
+        if not segments and remaining_messages >= self.historical_messages_split_threshold:
+            # Large backlogs are split into id ranges fetched concurrently. The ranges are stored before
+            # anything is fetched so the watermark only moves once every range below it is complete.
+            ranges = split_message_range(min_id, top_message_id, self.historical_messages_split_segments)
+            await self.database.create_historical_segments(chat_id, ranges)
+            segments = [{'start_id': start_id, 'end_id': end_id, 'progress_id': start_id} for start_id, end_id in ranges]
+            self.historical_messages_logger.info(f'Split chat \'{chat_title}\' into {len(segments)} segments up to message {top_message_id}')
+
+        progress = self.historical_messages_progress
+        chats_remaining = len(self.historical_messages_scheduled_chat_set)
+        task = progress.add_task(f"[cyan]Processing chat '{chat_title}'", total=max(remaining_messages, 0), chats_remaining=chats_remaining)
+        try:
+            if segments:
+                await asyncio.gather(*(
+                    self.process_historical_segment(chat_id, segment['start_id'], segment['end_id'], segment['progress_id'], task)
+                    for segment in segments
+                ))
             else:
-                min_id = 0
-                self.historical_messages_logger.info(f'Processing historical information for chat \'{chat_title}\' from inception')
+                async for messages in self.iter_historical_messages(chat_id, min_id):
+                    await self.queue_historical_messages(chat_id, messages, task)
+        finally:
+            progress.remove_task(task)
+
+    async def process_historical_segment(self, chat_id, start_id, end_id, progress_id, task):
+        if progress_id >= end_id:
+            return
+        async for messages in self.iter_historical_messages(chat_id, progress_id, end_id + 1):
+            await self.queue_historical_messages(chat_id, messages, task)
+            await self.database.queue_insert(HistoricalSegmentRow(chat_id, start_id, end_id, messages[-1].id))
+        # Messages up to end_id may have been deleted, so the last page doesn't necessarily reach it
+        await self.database.queue_insert(HistoricalSegmentRow(chat_id, start_id, end_id, end_id))
+
+    async def queue_historical_messages(self, chat_id, messages, task):
+        for message in messages:
+            # We don't need to insert chat as it has already been inserted by iter_dialogs
+            user, message_row = await rows_from_message(message, is_historical=True)
+            if user:
+                await self.database.queue_insert(user)
+            if message_row:
+                await self.database.queue_insert(message_row)
+        BACKFILL_MESSAGES.inc(len(messages), chat_id=chat_id)
+        self.historical_messages_progress.advance(task, len(messages))
+
+    async def iter_historical_messages(self, chat_id, min_id, max_id=0):
+        # Pages through the chat oldest first. max_id is exclusive, as in Telegram's API.
+        while True:
+            messages = await self.client.get_messages(chat_id, limit=self.historical_messages_batch_size, reverse=True, min_id=min_id, max_id=max_id)
+            if messages:
+                yield messages
+            if len(messages) < self.historical_messages_batch_size:
+                return
+            min_id = messages[-1].id
+
+    async def new_message_handler(self, event: events.NewMessage.Event):
+        # Only hands the event over, so Telethon's update dispatch never waits on entity lookups, the
+        # database or the websocket. When the workers fall behind, the bounded queues hold the dispatch back.
+        if not self.owns_messages(event.chat_id, event.is_channel):
+            return
+        queue = self.live_messages_queues[event.chat_id % len(self.live_messages_queues)]
+        await queue.put((time.perf_counter(), event))
+
+    async def live_messages_loop(self):
+        workers = [asyncio.create_task(self.live_messages_worker(queue)) for queue in self.live_messages_queues]
+        await asyncio.gather(*workers)
+
+    async def live_messages_worker(self, queue: asyncio.Queue):
+        REQUEST_PRIORITY.set(LIVE_PRIORITY)
+        while True:
+            received_time, event = await queue.get()
+            try:
+                await self.process_live_message(received_time, event)
+            except Exception:
+                self.main_logger.exception(f'Failed processing new message {event.message.id} in chat {event.chat_id}')
+            finally:
+                queue.task_done()
+
+    async def process_live_message(self, received_time, event: events.NewMessage.Event):
+        # Chat and sender are resolved once through the cache shared by the workers, then the rows and the
+        # broadcast go out side by side
+        chat = await self.get_live_entity(event.chat_id, event.get_chat)
+        sender = await self.get_live_entity(event.message.sender_id, event.message.get_sender)
+        await asyncio.gather(
+            self.queue_live_message(received_time, event, chat, sender),
+            self.broadcast_live_message(received_time, event, chat, sender),
+        )
 
-            wait_time = self.historical_messages_loop_wait_time
+    async def get_live_entity(self, entity_id, resolve):
+        if entity_id is not None and (entity := self.live_entity_cache.get(entity_id)) is not None:
+            return entity
+        entity = await resolve()
+        if entity_id is not None and entity is not None:
+            self.live_entity_cache.put(entity_id, entity)
+        return entity
+
+    async def queue_live_message(self, received_time, event: events.NewMessage.Event, chat, sender):
+        user, message = await rows_from_message(event.message, sender=sender)
+        if user:
+            await self.database.queue_insert(user)
+        await self.database.queue_insert(await ChatRow.from_new_message_event(event, chat))
+        if message:
+            await self.database.queue_insert(message, on_flush=lambda: LIVE_RECEIVE_TO_COMMIT.observe(time.perf_counter() - received_time))
 
-            total_messages = await self.get_total_number_of_messages(chat_id)
-            remaining_messages = total_messages - await self.database.get_historical_message_count(chat_id)
+    async def broadcast_live_message(self, received_time, event: events.NewMessage.Event, chat, sender):
+        serializable_message = await SerializableMessage.from_new_message_event(event, chat, sender)
+        await self.websocket.broadcast(serializable_message.to_dict())
+        LIVE_RECEIVE_TO_BROADCAST.observe(time.perf_counter() - received_time)
 
-            if remaining_messages == 0:
+    async def get_total_number_of_messages(self, chat_id):
+        # Returns the message count along with the id of the newest message, both from a single request
+        messages = await self.client.get_messages(chat_id, search='')
+        return messages.total, messages[0].id if messages else 0
+
+class RateControlledTelegramClient(TelegramClient):
+    # Sends every request through the rate controller at the priority of the calling task. FloodWaits are
+    # raised by Telethon right away (flood_sleep_threshold=0) so the controller sees them; only the
+    # caller that hit one waits it out before retrying.
+
+    def __init__(self, *args, rate_controller: RateController, **kwargs):
+        super().__init__(*args, flood_sleep_threshold=0, **kwargs)
+        self.rate_controller = rate_controller
+        self.logger = logging.getLogger('telegram_client')
+
+    async def __call__(self, request, ordered=False, flood_sleep_threshold=None):
+        priority = REQUEST_PRIORITY.get()
+        while True:
+            await self.rate_controller.acquire(priority)
+            start = time.perf_counter()
+            try:
+                result = await super().__call__(request, ordered=ordered)
+            except errors.FloodWaitError as e:
+                self.logger.warning(f'FloodWait of {e.seconds}s on {type(request).__name__} ({PRIORITY_NAMES[priority]})')
+                FLOOD_WAIT_SECONDS.inc(e.seconds, source=PRIORITY_NAMES[priority])
+                self.rate_controller.record_flood_wait(e.seconds)
+                await asyncio.sleep(e.seconds)
                 continue
+            self.rate_controller.record_success(time.perf_counter() - start)
+            return result
 
-            chats_remaining = len(self.historical_messages_scheduled_chat_set)
-
-            with Progress(*Progress.get_default_columns(), MessagesPerSecondColumn(), TextColumn(f'(Remaining chats: {chats_remaining})')) as progress:
-                task = progress.add_task(f"[cyan]Processing chat '{chat_title}'", total=remaining_messages)
-                async for message in self.client.iter_messages(chat_id, limit=None, reverse=True, min_id=min_id, wait_time=wait_time):
-                    # We don't need to insert chat as it has already been inserted by iter_dialogs
-                    if user := await UserRow.from_patched_message(message):
-                        await self.database.queue_insert(user)
-                    if message := await MessageRow.from_patched_message(message, is_historical=True):
-                        await self.database.queue_insert(message)
-                    progress.advance(task)
+SNAPSHOT_VERSION = 1
 
-    async def new_message_handler(self, event: events.NewMessage.Event):
-        if user := await UserRow.from_new_message_event(event):
-            await self.database.queue_insert(user)
-        if chat := await ChatRow.from_new_message_event(event):
-            await self.database.queue_insert(chat)
-        if message := await MessageRow.from_new_message_event(event):
-            await self.database.queue_insert(message)
+def write_snapshot(path, snapshot):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_path, path)
 
-        serializable_message = await SerializableMessage.from_new_message_event(event)
-        await self.websocket.broadcast(serializable_message.to_json())
+def read_snapshot(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
 
-    async def get_total_number_of_messages(self, chat_id):
-        return (await self.client.get_messages(chat_id, search='')).total
+def split_message_range(min_id, max_id, segments):
+    # Splits (min_id, max_id] into up to `segments` contiguous (start_id, end_id] ranges of similar size
+    bounds = sorted({min_id + (max_id - min_id) * i // segments for i in range(segments + 1)})
+    return list(zip(bounds, bounds[1:]))
 
 @dataclass
 class SerializableMessage:
+    sender_id: int
     sender: str
+    chat_id: int
     chat: str
+    message_id: int
+    date: datetime
     text: str
 
     @classmethod
-    async def from_new_message_event(cls, event: events.NewMessage.Event):
-        chat = await event.get_chat()
-        sender = await event.message.get_sender()
-        event.message.sender_id
+    async def from_new_message_event(cls, event: events.NewMessage.Event, chat=None, sender=None):
+        chat = chat or await event.get_chat()
+        sender = sender or await event.message.get_sender()
         return cls(
+            chat_id=event.chat_id,
             chat=getattr(chat, 'title', None) or get_full_name(chat),
+            sender_id=event.message.sender_id,
             sender=getattr(sender, 'title', None) or get_full_name(sender),
+            message_id=event.message.id,
+            date=event.message.date.replace(tzinfo=None),
             text=event.message.text,
         )
 
     def to_dict(self):
         return {
+            'sender_id': self.sender_id,
             'sender': self.sender,
+            'chat_id': self.chat_id,
             'chat': self.chat,
+            'message_id': self.message_id,
+            'date': self.date.isoformat(),
             'text': self.text,
         }
 
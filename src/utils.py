@@ -1,3 +1,8 @@
+import heapq
+import asyncio
+import itertools
+import contextvars
+
 from telethon import types
 
 async def async_enumerate(aiterable, start=0):
@@ -14,11 +19,81 @@ def get_username(user: types.User):
             return username.username
 
 def get_full_name(user: types.User):
+    return format_full_name(user.first_name, get_username(user), user.last_name)
+
+def format_full_name(first_name, username, last_name):
     names = []
-    if user.first_name:
-        names.append(user.first_name)
-    if username := get_username(user):
+    if first_name:
+        names.append(first_name)
+    if username:
         names.append(f"'{username}'")
-    if user.last_name:
-        names.append(user.last_name)
+    if last_name:
+        names.append(last_name)
     return ' '.join(names)
+
+# Request priorities, lower values go first. The priority of the current task's requests is read from
+# REQUEST_PRIORITY, so loops set it once instead of passing it to every call.
+LIVE_PRIORITY = 0
+DIALOGS_PRIORITY = 1
+BACKFILL_PRIORITY = 2
+PRIORITY_NAMES = {LIVE_PRIORITY: 'live', DIALOGS_PRIORITY: 'dialogs', BACKFILL_PRIORITY: 'backfill'}
+REQUEST_PRIORITY = contextvars.ContextVar('request_priority', default=BACKFILL_PRIORITY)
+
+class RateController:
+    # Spaces out the requests of every task sharing it so that together they stay under `rate` requests
+    # per second, handing out slots by priority. The rate adapts AIMD style: it grows by `increase` after
+    # each quick request and is cut by `decrease_factor` on a FloodWait, not growing again until the wait
+    # is over. Requests slower than `latency_threshold` seconds shave it down more gently.
+
+    def __init__(self, rate=1, min_rate=0.05, max_rate=30, increase=0.02, decrease_factor=0.5, latency_threshold=2, on_rate_change=None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_threshold = latency_threshold
+        self.on_rate_change = on_rate_change
+        self._waiters = []
+        self._order = itertools.count()
+        self._next_request_time = 0
+        self._hold_increase_until = 0
+        self._dispatcher = None
+
+    async def acquire(self, priority=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (REQUEST_PRIORITY.get() if priority is None else priority, next(self._order), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self._waiters:
+            if (delay := self._next_request_time - loop.time()) > 0:
+                # Waiters arriving during the sleep are ranked before the slot is handed out
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            future.set_result(None)
+            self._next_request_time = loop.time() + 1 / self.rate
+
+    def record_success(self, latency):
+        if latency > self.latency_threshold:
+            self.set_rate(self.rate * 0.9)
+        elif asyncio.get_running_loop().time() >= self._hold_increase_until:
+            self.set_rate(self.rate + self.increase)
+
+    def record_flood_wait(self, seconds):
+        # Requests caught in the same FloodWait only cut the rate once
+        loop = asyncio.get_running_loop()
+        if loop.time() >= self._hold_increase_until:
+            self.set_rate(self.rate * self.decrease_factor)
+        self._hold_increase_until = max(self._hold_increase_until, loop.time() + seconds)
+
+    def set_rate(self, rate):
+        self.rate = min(max(rate, self.min_rate), self.max_rate)
+        if self.on_rate_change is not None:
+            self.on_rate_change(self.rate)
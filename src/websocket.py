@@ -1,44 +1,311 @@
+import json
+import time
+import asyncio
 import logging
-from websockets import serve, broadcast
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs
+from websockets import serve
+from websockets.exceptions import ConnectionClosed
 
-from rich.json import JSON
 from rich import print
 
+from .utils import format_full_name
+from .metrics import WEBSOCKET_CLIENTS, WEBSOCKET_SEND_LAG, WEBSOCKET_MESSAGES_DROPPED
+
 class WebSocketManager:
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, database_manager=None):
         self.host = host
         self.port = port
-        self.connections = set()
+        self.clients = {}
         self.server = None
+        self.database = database_manager
+        self.request_handlers = {
+            'search': self.handle_search,
+            'subscribe': self.handle_subscribe,
+            'history': self.handle_history,
+        }
+        self.client_queue_size = 1000
+        self.slow_client_policy = 'drop' # or 'disconnect'
+        self.max_search_results = 500
+        self.max_history_stream_results = 100000
+        self.history_stream_page_size = 500
+        # Sequence numbers are millisecond timestamps bumped to stay strictly increasing, so they
+        # remain meaningful across restarts and can be mapped back to message dates
+        self.sequence = current_sequence()
+        self.replay_buffer_size = 10000
+        self.replay_buffer = deque(maxlen=self.replay_buffer_size)
+        self.replay_evicted_sequence = self.sequence
+        self.replay_database_slack = timedelta(seconds=10)
+        self.replay_database_page_size = 500
+        # Messages in chats shared by several ingest sessions arrive once per session
+        self.recent_message_keys = set()
+        self.recent_message_keys_order = deque(maxlen=self.replay_buffer_size)
         self.logger = logging.getLogger('websocket')
 
+        WEBSOCKET_CLIENTS.set_function(lambda: len(self.clients))
+
     async def run(self):
         self.server = await serve(self.handler, self.host, self.port)
         print(f'[bold green]Serving websocket at http://{self.host}:{self.port}[/bold green]')
         await self.server.serve_forever()
 
     async def stop(self):
-        if self.serve is not None:
-            await self.server.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
 
-    async def register(self, websocket):
-        self.connections.add(websocket)
-        self.logger(f"Client connected: {websocket}")
+    async def register(self, websocket, since=None, start_sender=True):
+        client = Client(websocket, self.client_queue_size)
+        if since is not None:
+            # Taken together with adding the client (no await in between) so nothing is missed or repeated
+            client.backlog.extend((message_key(message), data) for sequence, message, data in self.replay_buffer if sequence > since)
+        if start_sender:
+            client.sender_task = asyncio.create_task(self.sender(client))
+        self.clients[websocket] = client
+        self.logger.info(f"Client connected: {websocket}")
+        return client
 
     async def unregister(self, websocket):
-        self.connections.remove(websocket)
-        self.logger(f"Client disconnected: {websocket}")
+        client = self.clients.pop(websocket)
+        if client.sender_task is not None:
+            client.sender_task.cancel()
+        self.logger.info(f"Client disconnected: {websocket} ({client.dropped} messages dropped)")
+
+    async def broadcast(self, message: dict):
+        # The payload is serialized once and handed to every interested client's queue, so a slow
+        # client never holds up the others
+        key = message_key(message)
+        if key in self.recent_message_keys:
+            return
+        if len(self.recent_message_keys_order) == self.recent_message_keys_order.maxlen:
+            self.recent_message_keys.discard(self.recent_message_keys_order[0])
+        self.recent_message_keys_order.append(key)
+        self.recent_message_keys.add(key)
+        self.sequence = max(self.sequence + 1, current_sequence())
+        message['seq'] = self.sequence
+        data = json.dumps(message, default=to_json_value)
+        if len(self.replay_buffer) == self.replay_buffer.maxlen:
+            self.replay_evicted_sequence = self.replay_buffer[0][0]
+        self.replay_buffer.append((self.sequence, message, data))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'Broadcasting message {data[:120]}')
+        text = None
+        for client in list(self.clients.values()):
+            if client.keywords and text is None:
+                text = (message.get('text') or '').lower()
+            if client.matches(message, text):
+                self.enqueue(client, key, data)
 
-    async def broadcast(self, message: str):
-        formatted_message = JSON(message, indent=None).text
-        formatted_message.truncate(max_width=120)
-        self.logger.info(f'Broadcasting message {formatted_message}')
-        broadcast(self.connections, message)
+    def enqueue(self, client: 'Client', key, data: str):
+        try:
+            client.queue.put_nowait((time.perf_counter(), key, data))
+        except asyncio.QueueFull:
+            client.dropped += 1
+            WEBSOCKET_MESSAGES_DROPPED.inc()
+            if self.slow_client_policy == 'disconnect' and not client.closing:
+                client.closing = True
+                self.logger.warning(f'Disconnecting slow client {client.websocket}')
+                asyncio.create_task(client.websocket.close(1008, 'Client too slow'))
+
+    async def sender(self, client: 'Client'):
+        try:
+            while client.backlog:
+                key, data = client.backlog.popleft()
+                if key not in client.replayed_keys:
+                    await client.websocket.send(data)
+            # Messages broadcast while the database replay ran may have been replayed too
+            for _ in range(client.queue.qsize()):
+                queued_time, key, data = await client.queue.get()
+                WEBSOCKET_SEND_LAG.observe(time.perf_counter() - queued_time)
+                if key not in client.replayed_keys:
+                    await client.websocket.send(data)
+            client.replayed_keys = set()
+            while True:
+                queued_time, _, data = await client.queue.get()
+                WEBSOCKET_SEND_LAG.observe(time.perf_counter() - queued_time)
+                await client.websocket.send(data)
+        except ConnectionClosed:
+            pass
 
     async def handler(self, websocket, path):
-        await self.register(websocket)
+        # Reconnecting clients pass the last sequence number they saw as ?since=<seq>
+        since = parse_qs(urlparse(path).query).get('since')
+        since = int(since[0]) if since else None
+        # When the gap is older than the replay buffer, the client is registered first so that nothing
+        # broadcast during the database replay is lost, and its sender only starts once the replay is done
+        replay = since is not None and since < self.replay_evicted_sequence and self.database is not None
+        evicted_sequence = self.replay_evicted_sequence
+        client = await self.register(websocket, since, start_sender=not replay)
         try:
-            await websocket.wait_closed()
+            if replay:
+                client.replayed_keys = await self.replay_from_database(websocket, since, evicted_sequence)
+                client.sender_task = asyncio.create_task(self.sender(client))
+            async for request in websocket:
+                await self.handle_request(websocket, request)
         finally:
             await self.unregister(websocket)
+
+    async def replay_from_database(self, websocket, since, evicted_sequence):
+        # The gap is older than the replay buffer. Messages are sent from the database, marked as replayed
+        # and without a sequence number, up to the time of the newest evicted one: a message is dated
+        # before it is broadcast, so every evicted message falls in that window whatever order the buffer
+        # is in. Returns the keys sent, so the sender skips them in the buffered and queued messages.
+        # Sequence numbers only approximate message dates, so messages the client saw just before `since`
+        # may be sent again and clients should still deduplicate on (chat_id, message_id).
+        since_date = sequence_to_datetime(since) - self.replay_database_slack
+        until_date = sequence_to_datetime(evicted_sequence) + self.replay_database_slack
+        replayed_keys = set()
+        after = None
+        while True:
+            rows = await self.database.get_messages_since(since_date, after=after, until=until_date, limit=self.replay_database_page_size)
+            for row in rows:
+                await websocket.send(json.dumps(message_from_row(row), default=to_json_value))
+                replayed_keys.add((row['chat_id'], row['message_id']))
+            if len(rows) < self.replay_database_page_size:
+                return replayed_keys
+            after = (rows[-1]['date'], rows[-1]['chat_id'], rows[-1]['message_id'])
+
+    async def handle_request(self, websocket, raw_request):
+        # Requests are JSON objects with a "type" and an optional "id" that is echoed back in the response
+        request_id = None
+        try:
+            request = json.loads(raw_request)
+            request_id = request.get('id')
+            request_handler = self.request_handlers[request['type']]
+            response = await request_handler(self.clients[websocket], request)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.warning(f'Invalid request from {websocket}: {e!r}')
+            response = {'type': 'error', 'error': f'Invalid request: {e!r}'}
+        response['id'] = request_id
+        await websocket.send(json.dumps(response, default=to_json_value))
+
+    async def handle_search(self, client: 'Client', request):
+        if self.database is None:
+            return {'type': 'error', 'error': 'Search is not available'}
+        order = request.get('order', 'rank')
+        after = request.get('after')
+        if after is not None:
+            sort_value, chat_id, message_id = after
+            after = (datetime.fromisoformat(sort_value) if order == 'date' else float(sort_value), int(chat_id), int(message_id))
+        rows, next_cursor = await self.database.search_messages(
+            request['query'],
+            chat_id=request.get('chat_id'),
+            sender_id=request.get('sender_id'),
+            since=parse_datetime(request.get('since')),
+            until=parse_datetime(request.get('until')),
+            order=order,
+            after=after,
+            limit=min(int(request.get('limit', 50)), self.max_search_results),
+        )
+        return {
+            'type': 'search_results',
+            'messages': [dict(row) for row in rows],
+            'next_cursor': next_cursor,
+        }
+
+    async def handle_history(self, client: 'Client', request):
+        # With "stream": true, up to `limit` messages are sent as a series of history_page frames before
+        # the final response; otherwise the response carries a single page
+        if self.database is None:
+            return {'type': 'error', 'error': 'History is not available'}
+        order = request.get('order', 'id')
+        after = request.get('after')
+        if after is not None:
+            after = int(after) if order == 'id' else (datetime.fromisoformat(after[0]), int(after[1]))
+        history_request = {
+            'chat_id': int(request['chat_id']),
+            'order': order,
+            'direction': request.get('direction', 'backward'),
+            'since': parse_datetime(request.get('since')),
+            'until': parse_datetime(request.get('until')),
+        }
+        if not request.get('stream'):
+            rows, next_cursor = await self.database.get_chat_history(
+                **history_request, after=after, limit=min(int(request.get('limit', 100)), self.max_search_results),
+            )
+            return {'type': 'history', 'messages': [dict(row) for row in rows], 'next_cursor': next_cursor}
+        limit = min(int(request.get('limit', self.max_history_stream_results)), self.max_history_stream_results)
+        sent = 0
+        next_cursor = after
+        while sent < limit:
+            rows, next_cursor = await self.database.get_chat_history(
+                **history_request, after=next_cursor, limit=min(self.history_stream_page_size, limit - sent),
+            )
+            if rows:
+                # send() waits for the socket to drain, so a slow reader holds back the next page
+                await client.websocket.send(json.dumps({
+                    'type': 'history_page',
+                    'id': request.get('id'),
+                    'messages': [dict(row) for row in rows],
+                }, default=to_json_value))
+                sent += len(rows)
+            if next_cursor is None:
+                break
+        return {'type': 'history', 'messages': [], 'count': sent, 'next_cursor': next_cursor}
+
+    async def handle_subscribe(self, client: 'Client', request):
+        # Empty or missing filters match everything
+        client.chat_ids = set(map(int, request.get('chat_ids') or [])) or None
+        client.sender_ids = set(map(int, request.get('sender_ids') or [])) or None
+        client.keywords = [keyword.lower() for keyword in request.get('keywords') or []] or None
+        return {
+            'type': 'subscribed',
+            'chat_ids': sorted(client.chat_ids or []),
+            'sender_ids': sorted(client.sender_ids or []),
+            'keywords': client.keywords or [],
+        }
+
+class Client:
+
+    def __init__(self, websocket, queue_size):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(queue_size)
+        self.sender_task = None
+        self.backlog = deque()
+        self.replayed_keys = set()
+        self.chat_ids = None
+        self.sender_ids = None
+        self.keywords = None
+        self.dropped = 0
+        self.closing = False
+
+    def matches(self, message: dict, text: str | None):
+        if self.chat_ids is not None and message.get('chat_id') not in self.chat_ids:
+            return False
+        if self.sender_ids is not None and message.get('sender_id') not in self.sender_ids:
+            return False
+        if self.keywords is not None and not any(keyword in text for keyword in self.keywords):
+            return False
+        return True
+
+def current_sequence():
+    return int(time.time() * 1000)
+
+def sequence_to_datetime(sequence):
+    return datetime.fromtimestamp(sequence / 1000, timezone.utc).replace(tzinfo=None)
+
+def message_key(message: dict):
+    return message.get('chat_id'), message.get('message_id')
+
+def message_from_row(row):
+    return {
+        'seq': None,
+        'replayed': True,
+        'sender_id': row['sender_id'],
+        'sender': format_full_name(row['first_name'], row['username'], row['last_name']) or row['chat_title'],
+        'chat_id': row['chat_id'],
+        'chat': row['chat_title'],
+        'message_id': row['message_id'],
+        'date': row['date'],
+        'text': row['text'],
+    }
+
+def parse_datetime(value):
+    return datetime.fromisoformat(value) if value is not None else None
+
+def to_json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
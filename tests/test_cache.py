@@ -0,0 +1,46 @@
+from src import cache
+from src.cache import EntityCache, LookupCache
+
+def test_entity_cache_hits_only_unchanged_entities():
+    entity_cache = EntityCache(max_size=10)
+    assert not entity_cache.check_and_update(('user', 1), 'a')
+    assert entity_cache.check_and_update(('user', 1), 'a')
+    assert not entity_cache.check_and_update(('user', 1), 'b')
+    assert entity_cache.stats() == {'size': 1, 'hits': 1, 'misses': 2, 'hit_ratio': 1 / 3}
+
+def test_entity_cache_evicts_least_recently_used():
+    entity_cache = EntityCache(max_size=2)
+    entity_cache.check_and_update(1, 'a')
+    entity_cache.check_and_update(2, 'b')
+    entity_cache.check_and_update(1, 'a')
+    entity_cache.check_and_update(3, 'c')
+    assert len(entity_cache) == 2
+    assert entity_cache.check_and_update(1, 'a')
+    assert not entity_cache.check_and_update(2, 'b')
+
+def test_entity_cache_invalidate():
+    entity_cache = EntityCache(max_size=10)
+    entity_cache.check_and_update(1, 'a')
+    entity_cache.invalidate([1, 2])
+    assert not entity_cache.check_and_update(1, 'a')
+
+def test_lookup_cache_expires_entries(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    lookup_cache = LookupCache(max_size=10, ttl=5)
+    lookup_cache.put('chat', 'entity')
+    now[0] += 4.9
+    assert lookup_cache.get('chat') == 'entity'
+    now[0] += 0.1
+    assert lookup_cache.get('chat') is None
+    assert len(lookup_cache) == 0
+
+def test_lookup_cache_evicts_least_recently_used():
+    lookup_cache = LookupCache(max_size=2, ttl=60)
+    lookup_cache.put(1, 'a')
+    lookup_cache.put(2, 'b')
+    assert lookup_cache.get(1) == 'a'
+    lookup_cache.put(3, 'c')
+    assert lookup_cache.get(2) is None
+    assert lookup_cache.get(1) == 'a'
+    assert lookup_cache.get(3) == 'c'
@@ -0,0 +1,93 @@
+import re
+from datetime import datetime
+
+import pytest
+
+from src.database import DatabaseManager
+
+pytestmark = pytest.mark.asyncio
+
+class RecordingPool:
+    # Read pool stand-in returning canned rows and keeping the last query
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.query = None
+        self.args = None
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def fetch(self, query, *args):
+        self.query = ' '.join(query.split())
+        self.args = args
+        return self.rows
+
+def database_with_rows(rows):
+    database = DatabaseManager(None)
+    database.read_pool = RecordingPool(rows)
+    return database
+
+def search_row(message_id, rank=0.5, date=datetime(2024, 1, 1)):
+    return {'chat_id': -100, 'message_id': message_id, 'rank': rank, 'date': date}
+
+async def test_search_first_page_by_rank():
+    database = database_with_rows([search_row(3), search_row(2)])
+    rows, next_cursor = await database.search_messages('hello', limit=2)
+    assert next_cursor == (0.5, -100, 2)
+    assert 'ORDER BY rank DESC, chat_id DESC, message_id DESC' in database.read_pool.query
+    assert 'WHERE (rank, chat_id, message_id)' not in database.read_pool.query
+    assert database.read_pool.args == ('hello', 2)
+
+async def test_search_next_page_by_date_with_filters():
+    database = database_with_rows([search_row(1)])
+    after = (datetime(2024, 1, 2), -100, 7)
+    rows, next_cursor = await database.search_messages('hello', chat_id=-100, since=datetime(2023, 1, 1), order='date', after=after, limit=2)
+    # A short page is the last one
+    assert next_cursor is None
+    assert 'm.chat_id = $2' in database.read_pool.query
+    assert 'm.date >= $3' in database.read_pool.query
+    assert 'WHERE (date, chat_id, message_id) < ($4::timestamp, $5, $6)' in database.read_pool.query
+    assert database.read_pool.query.endswith('LIMIT $7')
+    assert database.read_pool.args == ('hello', -100, datetime(2023, 1, 1), *after, 2)
+
+async def test_search_unknown_order():
+    with pytest.raises(ValueError):
+        await database_with_rows([]).search_messages('hello', order='sender')
+
+def history_row(message_id, date=datetime(2024, 1, 1)):
+    return {'chat_id': -100, 'message_id': message_id, 'date': date}
+
+async def test_history_backward_by_id():
+    database = database_with_rows([history_row(9), history_row(8)])
+    rows, next_cursor = await database.get_chat_history(-100, after=10, limit=2)
+    assert next_cursor == 8
+    assert 'WHERE chat_id = $1 AND (message_id) < ($2)' in database.read_pool.query
+    assert 'ORDER BY message_id DESC LIMIT $3' in database.read_pool.query
+    assert database.read_pool.args == (-100, 10, 2)
+
+async def test_history_forward_by_date():
+    date = datetime(2024, 3, 1)
+    database = database_with_rows([history_row(5, date), history_row(6, date)])
+    rows, next_cursor = await database.get_chat_history(
+        -100, order='date', direction='forward', since=datetime(2024, 1, 1), after=(date, 4), limit=2,
+    )
+    assert next_cursor == (date, 6)
+    assert 'date >= $2 AND (date, message_id) > ($3, $4)' in database.read_pool.query
+    assert re.search(r'ORDER BY date ASC, message_id ASC LIMIT \$5', database.read_pool.query)
+    assert database.read_pool.args == (-100, datetime(2024, 1, 1), date, 4, 2)
+
+async def test_history_last_page_has_no_cursor():
+    database = database_with_rows([history_row(1)])
+    assert (await database.get_chat_history(-100, limit=2))[1] is None
+
+@pytest.mark.parametrize('order, direction', [('sender', 'backward'), ('id', 'sideways')])
+async def test_history_rejects_unknown_order_or_direction(order, direction):
+    with pytest.raises(ValueError):
+        await database_with_rows([]).get_chat_history(-100, order=order, direction=direction)
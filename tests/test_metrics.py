@@ -0,0 +1,56 @@
+import math
+
+import pytest
+
+from src.metrics import Counter, Gauge, Histogram, REGISTRY, format_value
+
+@pytest.fixture(autouse=True)
+def registry():
+    # Metrics register themselves globally, keep the ones created here out of it
+    metrics = dict(REGISTRY.metrics)
+    yield REGISTRY
+    REGISTRY.metrics = metrics
+
+def test_counter_render_with_labels():
+    counter = Counter('test_rows_total', 'Rows', ['table'])
+    counter.inc(2, table='messages')
+    counter.inc(table='messages')
+    counter.inc(table='a "quoted"\nname')
+    assert counter.render().splitlines() == [
+        '# HELP test_rows_total Rows',
+        '# TYPE test_rows_total counter',
+        'test_rows_total{table="messages"} 3',
+        'test_rows_total{table="a \\"quoted\\"\\nname"} 1',
+    ]
+
+def test_gauge_function_is_read_at_render_time():
+    gauge = Gauge('test_queue_rows', 'Rows queued')
+    size = [1]
+    gauge.set_function(lambda: size[0])
+    size[0] = 7
+    assert gauge.render().splitlines()[-1] == 'test_queue_rows 7'
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_latency_seconds', 'Latency', ['table'], buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, table='users')
+    assert histogram.render().splitlines()[2:] == [
+        'test_latency_seconds_bucket{table="users",le="0.1"} 2',
+        'test_latency_seconds_bucket{table="users",le="1"} 3',
+        'test_latency_seconds_bucket{table="users",le="+Inf"} 4',
+        'test_latency_seconds_sum{table="users"} 3.65',
+        'test_latency_seconds_count{table="users"} 4',
+    ]
+
+def test_registry_renders_every_metric(registry):
+    Counter('test_a_total', 'A').inc()
+    Gauge('test_b', 'B').set(1.5)
+    text = registry.render()
+    assert text.endswith('\n')
+    assert 'test_a_total 1\n' in text
+    assert 'test_b 1.5\n' in text
+
+def test_format_value():
+    assert format_value(math.inf) == '+Inf'
+    assert format_value(3.0) == '3'
+    assert format_value(0.25) == '0.25'
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from src.utils import RateController, REQUEST_PRIORITY, LIVE_PRIORITY, DIALOGS_PRIORITY, BACKFILL_PRIORITY
+
+pytestmark = pytest.mark.asyncio
+
+async def test_slots_go_by_priority():
+    controller = RateController(rate=20, max_rate=20)
+    await controller.acquire(BACKFILL_PRIORITY)
+    granted = []
+
+    async def request(name, priority):
+        await controller.acquire(priority)
+        granted.append(name)
+
+    # All three wait for the next slot, which the dispatcher hands out by priority then arrival
+    await asyncio.gather(
+        request('backfill', BACKFILL_PRIORITY),
+        request('live', LIVE_PRIORITY),
+        request('dialogs', DIALOGS_PRIORITY),
+        request('live 2', LIVE_PRIORITY),
+    )
+    assert granted == ['live', 'live 2', 'dialogs', 'backfill']
+
+async def test_priority_defaults_to_the_context():
+    controller = RateController(rate=20, max_rate=20)
+    await controller.acquire()
+    granted = []
+
+    async def request(name, priority):
+        REQUEST_PRIORITY.set(priority)
+        await controller.acquire()
+        granted.append(name)
+
+    await asyncio.gather(request('backfill', BACKFILL_PRIORITY), request('live', LIVE_PRIORITY))
+    assert granted == ['live', 'backfill']
+
+async def test_requests_are_spaced_by_the_rate():
+    controller = RateController(rate=50, max_rate=50)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for _ in range(5):
+        await controller.acquire()
+    assert loop.time() - start >= 4 / 50 * 0.9
+
+async def test_flood_wait_cuts_once_and_holds_increase():
+    rates = []
+    controller = RateController(rate=8, increase=1, on_rate_change=rates.append)
+    controller.record_flood_wait(0.05)
+    controller.record_flood_wait(0.05)
+    assert controller.rate == 4
+    controller.record_success(0.1)
+    assert controller.rate == 4
+    await asyncio.sleep(0.06)
+    controller.record_success(0.1)
+    assert controller.rate == 5
+    assert rates == [4, 5]
+
+async def test_rate_stays_within_bounds():
+    controller = RateController(rate=1, min_rate=0.5, max_rate=1.5, increase=1)
+    controller.record_success(0.1)
+    assert controller.rate == 1.5
+    controller.record_success(controller.latency_threshold + 1)
+    assert controller.rate == pytest.approx(1.35)
+    for _ in range(5):
+        controller.record_flood_wait(0)
+    assert controller.rate == 0.5
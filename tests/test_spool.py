@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from src.spool import Spool, RECORD_HEADER
+
+pytestmark = pytest.mark.asyncio
+
+class Recorder:
+
+    def __init__(self, fail_at=None):
+        self.batches = []
+        self.fail_at = fail_at
+
+    async def __call__(self, kind, records):
+        if self.fail_at is not None and len(self.batches) == self.fail_at:
+            self.fail_at = None
+            raise ConnectionError('database down')
+        self.batches.append((kind, records))
+
+async def test_replay_in_order_and_removes_segments(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(3):
+        await spool.append('MessageRow', [(i,)])
+    recorder = Recorder()
+    await spool.replay(recorder)
+    assert recorder.batches == [('MessageRow', [(0,)]), ('MessageRow', [(1,)]), ('MessageRow', [(2,)])]
+    assert not spool.has_pending()
+    assert os.listdir(tmp_path) == []
+
+async def test_replay_resumes_mid_segment(tmp_path):
+    spool = Spool(str(tmp_path))
+    for i in range(4):
+        await spool.append('MessageRow', [(i,)])
+    recorder = Recorder(fail_at=2)
+    with pytest.raises(ConnectionError):
+        await spool.replay(recorder)
+    assert spool.has_pending()
+    await spool.replay(recorder)
+    # The batches written before the failure are not replayed a second time
+    assert [records for _, records in recorder.batches] == [[(0,)], [(1,)], [(2,)], [(3,)]]
+    assert not spool.has_pending()
+
+async def test_segments_roll_over_and_survive_restart(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=1)
+    await spool.append('UserRow', [(1,)])
+    await spool.append('UserRow', [(2,)])
+    assert len(spool.segments) == 2
+    spool._seal()
+
+    restarted = Spool(str(tmp_path))
+    assert restarted.segments == spool.segments
+    await restarted.append('UserRow', [(3,)])
+    recorder = Recorder()
+    await restarted.replay(recorder)
+    assert [records for _, records in recorder.batches] == [[(1,)], [(2,)], [(3,)]]
+
+async def test_torn_record_is_ignored(tmp_path):
+    spool = Spool(str(tmp_path))
+    await spool.append('ChatRow', [(1,)])
+    await spool.append('ChatRow', [(2,)])
+    spool._seal()
+    # A crash in the middle of a write leaves a header promising more bytes than were written
+    with open(os.path.join(tmp_path, spool.segments[-1]), 'ab') as f:
+        f.write(RECORD_HEADER.pack(100) + b'partial')
+
+    recorder = Recorder()
+    await Spool(str(tmp_path)).replay(recorder)
+    assert [records for _, records in recorder.batches] == [[(1,)], [(2,)]]
@@ -0,0 +1,19 @@
+import pytest
+
+from src.telegram import split_message_range
+
+def test_split_covers_the_range_without_overlap():
+    ranges = split_message_range(1000, 101000, 4)
+    assert ranges == [(1000, 26000), (26000, 51000), (51000, 76000), (76000, 101000)]
+
+@pytest.mark.parametrize('min_id, max_id, segments', [(0, 10, 3), (5, 1000003, 7), (0, 1, 4), (100, 103, 10)])
+def test_split_is_contiguous(min_id, max_id, segments):
+    ranges = split_message_range(min_id, max_id, segments)
+    assert ranges[0][0] == min_id
+    assert ranges[-1][1] == max_id
+    assert all(start < end for start, end in ranges)
+    assert all(previous[1] == current[0] for previous, current in zip(ranges, ranges[1:]))
+    assert len(ranges) <= segments
+
+def test_split_of_an_empty_range():
+    assert split_message_range(10, 10, 4) == []